@@ -0,0 +1,15 @@
+"""Общая подготовка бенчмарков: временная БД и импорт bot.py из корня репозитория."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix="rofl-bench-")
+os.environ.setdefault("DB_PATH", os.path.join(TMP_DIR, "events.db"))
+sys.path.insert(0, ROOT)
+
+import logging  # noqa: E402
+
+import bot  # noqa: E402,F401
+
+logging.getLogger().setLevel(logging.WARNING)
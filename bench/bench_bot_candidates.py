@@ -0,0 +1,137 @@
+"""
+Кандидаты в боты из сообщения: прежний re.findall по всему тексту против
+extract_bot_candidates (entities + мемо). На одно бизнес-сообщение extract_bot_candidates
+зовут дважды — check_scam_bots и проверка новых ботов, второй вызов берётся из мемо.
+Раньше скам-проверка отдельно гоняла автомат Ахо-Корасик по тексту — итог сравнивается целиком.
+
+    python bench/bench_bot_candidates.py [сообщений]
+"""
+import random
+import re
+import sys
+import time
+
+from _setup import bot
+
+from aiogram import types
+from bench_scam_match import AhoCorasick, automaton_lookup
+
+FILLER = (
+    "Добрый день! Напоминаю про завтрашнюю встречу в 11:00, адрес скину позже. "
+    "Если не успеваете — напишите, перенесём. Оплата как обычно, чек пришлю после."
+).split()
+BOTS = ["giftdrop_bot", "StarsExchangeBot", "helper_robot", "wallet", "durov"]
+
+
+def old_candidates(message: types.Message) -> set:
+    """Как было в warn_about_new_bot_and_offer_report."""
+    bot_candidates = set()
+    if message.from_user.is_bot and message.from_user.username:
+        bot_candidates.add(message.from_user.username.lower())
+    if message.forward_from and message.forward_from.is_bot and message.forward_from.username:
+        bot_candidates.add(message.forward_from.username.lower())
+    if message.text or message.caption:
+        text = message.text or message.caption or ""
+        mentions = re.findall(r'@([a-zA-Z0-9_]{5,32}(?:_?bot|_?robot))\b', text, re.IGNORECASE)
+        for m in mentions:
+            bot_candidates.add(m.lower())
+    if message.forward_sender_name:
+        name_lower = message.forward_sender_name.lower()
+        if "bot" in name_lower or "robot" in name_lower:
+            pseudo = name_lower.replace(" ", "_").replace(".", "")
+            if pseudo.endswith(("bot", "robot")):
+                bot_candidates.add(pseudo)
+    return bot_candidates
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def make_message(i: int, rnd: random.Random, mentions: bool = True, with_entities: bool = True) -> types.Message:
+    """Реалистичный текст с разметкой, как её присылает Telegram."""
+    text = ""
+    entities = []
+    for _ in range(rnd.randint(8, 120)):
+        if not mentions:
+            word = rnd.choice(FILLER) if rnd.random() > 0.02 else "😀"
+        elif rnd.random() < 0.03:
+            name = "@" + rnd.choice(BOTS)
+            entities.append(types.MessageEntity(type="mention", offset=utf16_len(text), length=utf16_len(name)))
+            word = name
+        elif rnd.random() < 0.02:
+            word = "https://t.me/" + rnd.choice(BOTS)
+            entities.append(types.MessageEntity(type="url", offset=utf16_len(text), length=utf16_len(word)))
+        elif rnd.random() < 0.02:
+            word = "😀"
+        else:
+            word = rnd.choice(FILLER)
+        text += word + " "
+    return types.Message(
+        message_id=i,
+        date=0,
+        chat=types.Chat(id=1, type="private"),
+        from_user=types.User(id=2, is_bot=False, first_name="Клиент"),
+        forward_sender_name="Gift Bot" if rnd.random() < 0.05 else None,
+        text=text,
+        entities=(entities or None) if with_entities else None,
+    )
+
+
+def per_message(fn, messages, calls: int) -> float:
+    started = time.perf_counter()
+    for message in messages:
+        for _ in range(calls):
+            fn(message)
+    return (time.perf_counter() - started) / len(messages) * 1e6
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rnd = random.Random(3)
+    messages = [make_message(i, rnd) for i in range(count)]
+    avg_len = sum(len(m.text) for m in messages) / count
+    blocklist = [f"scam{i:05d}_bot" for i in range(1000)] + ["giftdrop_bot"]
+    bot.SCAM_BOTS.clear()
+    bot.SCAM_BOTS.update({name: "" for name in blocklist})
+    matcher = AhoCorasick(blocklist)
+
+    # Обычная переписка без упоминаний и ссылок, и сообщения из кэша без entities (фолбэк)
+    plain = [make_message(i, rnd, mentions=False) for i in range(count)]
+    bare = [make_message(i, rnd, with_entities=False) for i in range(count)]
+
+    old = per_message(old_candidates, messages, 1)
+    bot._BOT_CANDIDATES_CACHE.clear()
+    cold = per_message(bot.extract_bot_candidates, messages, 1)
+    # Повторный вызов для сообщения, которое ещё в мемо
+    recent = messages[-bot._BOT_CANDIDATES_CACHE_MAX:]
+    memo = per_message(bot.extract_bot_candidates, recent, 1)
+    old_plain = per_message(old_candidates, plain, 1)
+    new_plain = per_message(bot.extract_bot_candidates, plain, 1)
+    old_bare = per_message(old_candidates, bare, 1)
+    bot._BOT_CANDIDATES_CACHE.clear()
+    new_bare = per_message(bot.extract_bot_candidates, bare, 1)
+
+    def old_both(message: types.Message) -> None:
+        automaton_lookup(matcher, message.text)
+        old_candidates(message)
+
+    def new_both(message: types.Message) -> None:
+        bot.find_scam_bots(message)
+        bot.extract_bot_candidates(message)
+
+    old_total = per_message(old_both, messages, 1)
+    bot._BOT_CANDIDATES_CACHE.clear()
+    new_total = per_message(new_both, messages, 1)
+
+    print(f"{count} messages, avg {avg_len:.0f} chars, scam blocklist {len(blocklist)}")
+    print(f"  candidates, re.findall over text: {old:.1f} us/message")
+    print(f"  candidates, extract_bot_candidates: {cold:.1f} us/message, from memo {memo:.1f} us")
+    print(f"  no mentions or links: re.findall {old_plain:.1f} us, extract_bot_candidates {new_plain:.1f} us")
+    print(f"  mentions, no entities: re.findall {old_bare:.1f} us, extract_bot_candidates {new_bare:.1f} us")
+    print(f"  scam check + new-bot check, before: {old_total:.1f} us/message")
+    print(f"  scam check + new-bot check, now:    {new_total:.1f} us/message")
+
+
+if __name__ == "__main__":
+    main()
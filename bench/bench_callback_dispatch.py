@@ -0,0 +1,93 @@
+"""
+Стоимость диспетчеризации нажатия кнопки через Dispatcher.feed_update:
+прежняя регистрация (по лямбда-фильтру на каждую кнопку + startswith для кнопок
+с данными) против одного CallbackRouter. Хендлеры пустые — меряется только выбор.
+
+    python bench/bench_callback_dispatch.py [нажатий]
+"""
+import asyncio
+import sys
+import time
+
+from _setup import bot
+
+from aiogram import Bot, Dispatcher, types
+
+LEGACY_PREFIXES = ("report_new_bot_", "approve_bot_", "mark_scam_", "ignore_bot_")
+
+
+async def noop(callback: types.CallbackQuery, *args) -> None:
+    pass
+
+
+def exact_routes() -> list:
+    router = bot.CallbackRouter()
+    bot.register_callback_routes(router)
+    return list(router.exact)
+
+
+def old_dispatcher(names: list) -> Dispatcher:
+    dp = Dispatcher()
+    for name in names:
+        dp.callback_query.register(noop, lambda c, name=name: c.data == name)
+    for prefix in LEGACY_PREFIXES:
+        dp.callback_query.register(noop, lambda c, prefix=prefix: c.data.startswith(prefix))
+    return dp
+
+
+def new_dispatcher(names: list) -> Dispatcher:
+    router = bot.CallbackRouter()
+    for name in names:
+        router.route(name, noop)
+    router.route_token("rp", noop)
+    dp = Dispatcher()
+    dp.callback_query.register(router.dispatch)
+    return dp
+
+
+def press(update_id: int, data: str) -> types.Update:
+    return types.Update(
+        update_id=update_id,
+        callback_query=types.CallbackQuery(
+            id=str(update_id),
+            from_user=types.User(id=1, is_bot=False, first_name="Bench"),
+            chat_instance="bench",
+            data=data,
+        ),
+    )
+
+
+async def per_press(dp: Dispatcher, tg: Bot, data: str, n: int) -> float:
+    updates = [press(i, data) for i in range(n)]
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(tg, update)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+async def run(n: int) -> None:
+    names = exact_routes()
+    tg = Bot("123456:bench")
+    old, new = old_dispatcher(names), new_dispatcher(names)
+    token = bot.store_callback_payload("bot_example_bot", 123456789)
+
+    cases = [
+        ("first exact route", names[0], names[0]),
+        ("last exact route", names[-1], names[-1]),
+        ("bot report button", "report_new_bot_example_bot_123456789", f"rp{bot._CALLBACK_SEP}{token}"),
+    ]
+    print(f"{len(names)} exact routes, {len(LEGACY_PREFIXES)} prefixed, {n} presses each")
+    for label, old_data, new_data in cases:
+        before = await per_press(old, tg, old_data, n)
+        after = await per_press(new, tg, new_data, n)
+        print(f"  {label:<18} {before:7.1f} us -> {after:6.1f} us")
+    await tg.session.close()
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    asyncio.run(run(n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Запись событий: построчный INSERT + commit (как было) против фоновой пакетной записи.
+
+    python bench/bench_db_writer.py [N]
+"""
+import asyncio
+import sys
+import time
+
+from _setup import bot
+
+
+def per_row_commit(n: int) -> float:
+    started = time.perf_counter()
+    for i in range(n):
+        bot._cur.execute(
+            "INSERT INTO events (owner_id, event_type, author, content, old_content, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (1, "edited", "bench", f"text {i}", None, int(time.time())),
+        )
+        bot._db.commit()
+    return time.perf_counter() - started
+
+
+async def batched(n: int) -> float:
+    bot.start_db_writer()
+    started = time.perf_counter()
+    for i in range(n):
+        bot.save_event(2, "edited", "bench", f"text {i}")
+    enqueue = time.perf_counter() - started
+    await bot.stop_db_writer()
+    print(f"  batched: enqueue on event loop {enqueue * 1000:.1f} ms")
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    base = per_row_commit(n)
+    new = asyncio.run(batched(n))
+    print(f"{n} events: per-row commit {base:.3f} s ({n / base:.0f}/s), "
+          f"batched {new:.3f} s ({n / new:.0f}/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Поиск скам-ботов в тексте: автомат Ахо-Корасик по всему блоклисту (как было)
+против find_scam_bots — кандидаты из extract_bot_candidates, дальше проверка по множеству.
+
+    python bench/bench_scam_match.py [размер блоклиста] [сообщений]
+"""
+import random
+import string
+import sys
+import time
+from collections import deque
+
+from _setup import bot
+
+from aiogram import types
+
+NAME_CHARS = string.ascii_lowercase + string.digits + "_"
+FILLER = (
+    "привет, посмотри этот канал, там раздают подарки и звёзды бесплатно. "
+    "ссылка ниже, только никому не говори, акция до вечера "
+).split()
+
+
+class AhoCorasick:
+    """Прежний автомат: все вхождения множества строк за один проход по тексту."""
+
+    def __init__(self, patterns) -> None:
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(pattern)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def iter_matches(self, text: str):
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for pattern in out[node]:
+                yield i, pattern
+
+
+def automaton_lookup(matcher: AhoCorasick, text: str) -> set:
+    haystack = text.lower()
+    hits = set()
+    for end, name in matcher.iter_matches(haystack):
+        start = end - len(name) + 1
+        if start > 0 and haystack[start - 1] in "@/" and (
+            end + 1 >= len(haystack) or not (haystack[end + 1].isalnum() or haystack[end + 1] == "_")
+        ):
+            hits.add(name)
+    return hits
+
+
+def random_name(rnd: random.Random) -> str:
+    return rnd.choice(string.ascii_lowercase) + "".join(rnd.choice(NAME_CHARS) for _ in range(rnd.randint(5, 14))) + "bot"
+
+
+def make_text(rnd: random.Random, blocklist: list) -> str:
+    words = [rnd.choice(FILLER) for _ in range(rnd.randint(5, 60))]
+    for _ in range(rnd.randint(0, 3)):
+        name = rnd.choice(blocklist) if rnd.random() < 0.3 else random_name(rnd)
+        words.insert(rnd.randrange(len(words) + 1), rnd.choice(("@", "https://t.me/")) + name)
+    return " ".join(words)
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    rnd = random.Random(7)
+    names = [random_name(rnd) for _ in range(size)]
+    bot.SCAM_BOTS.clear()
+    bot.SCAM_BOTS.update({name: "" for name in names})
+
+    started = time.perf_counter()
+    matcher = AhoCorasick(names)
+    build = time.perf_counter() - started
+
+    texts = [make_text(rnd, names) for _ in range(count)]
+    messages = [
+        types.Message(message_id=i, date=0, chat=types.Chat(id=1, type="private"), text=text)
+        for i, text in enumerate(texts)
+    ]
+
+    started = time.perf_counter()
+    ac_hits = [automaton_lookup(matcher, t) for t in texts]
+    ac_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    re_hits = [bot.find_scam_bots(m) for m in messages]
+    re_time = time.perf_counter() - started
+
+    mismatches = sum(1 for a, b in zip(ac_hits, re_hits) if a != b)
+    avg_len = sum(map(len, texts)) / len(texts)
+    print(f"blocklist {size} names, {count} messages (avg {avg_len:.0f} chars), mismatches: {mismatches}")
+    print(f"  aho-corasick:  build {build * 1000:.0f} ms, {ac_time / count * 1e6:.1f} us/message")
+    print(f"  find_scam_bots (candidates + set): {re_time / count * 1e6:.1f} us/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+format_text_diff по размерам сообщений: старый посимвольный SequenceMatcher
+против текущего пословного диффа с бюджетом DIFF_MAX_WORK. Плюс — насколько
+задерживается event loop, если считать дифф прямо в нём или через asyncio.to_thread
+(поток не помогает: SequenceMatcher держит GIL).
+
+    python bench/bench_text_diff.py [повторов]
+"""
+import asyncio
+import random
+import sys
+import time
+from difflib import SequenceMatcher
+from html import escape
+
+from _setup import bot
+
+SIZES = (64, 256, 512, 768, 1024, 1536, 2048, 4096)
+CHANGED = 0.3
+
+WORDS = "привет как дела сегодня завтра встреча в офисе созвон отчёт hello world ok".split()
+
+
+def make_pair(size: int, rnd: random.Random) -> tuple:
+    words = []
+    while sum(len(w) + 1 for w in words) < size:
+        words.append(rnd.choice(WORDS))
+    old = " ".join(words)[:size]
+    new_words = [rnd.choice(WORDS) if rnd.random() < CHANGED else w for w in words]
+    return old, " ".join(new_words)[:size]
+
+
+def char_diff(old_text: str, new_text: str) -> str:
+    """Как было до токенов: SequenceMatcher по символам без ограничений."""
+    parts = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_text, new_text).get_opcodes():
+        if tag == "equal":
+            parts.append(escape(old_text[i1:i2]))
+        else:
+            if i2 > i1:
+                parts.append(f"<s>{escape(old_text[i1:i2])}</s>")
+            if j2 > j1:
+                parts.append(f"<b>{escape(new_text[j1:j2])}</b>")
+    return "".join(parts)
+
+
+def timed(fn, pairs) -> float:
+    started = time.perf_counter()
+    for old, new in pairs:
+        fn(old, new)
+    return (time.perf_counter() - started) / len(pairs)
+
+
+async def loop_stall(run_diff, pairs) -> float:
+    """Максимальная задержка тика event loop, пока считаются диффы."""
+    worst = 0.0
+    done = False
+
+    async def ticker() -> None:
+        nonlocal worst
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(0)
+            worst = max(worst, time.perf_counter() - started)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    for old, new in pairs:
+        await run_diff(old, new)
+        # Даём тикеру шанс замерить каждый вызов отдельно
+        await asyncio.sleep(0)
+    done = True
+    await task
+    return worst
+
+
+async def inline(old: str, new: str) -> str:
+    return bot.format_text_diff(old, new)
+
+
+async def threaded(old: str, new: str) -> str:
+    return await asyncio.to_thread(bot.format_text_diff, old, new)
+
+
+def main() -> None:
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rnd = random.Random(1)
+    print(f"{'size':>6} {'char (old)':>12} {'word+budget':>12} {'stall inline':>13} {'stall thread':>13}")
+    for size in SIZES:
+        pairs = [make_pair(size, rnd) for _ in range(repeats)]
+        old_ms = timed(char_diff, pairs) * 1000
+        new_ms = timed(bot.format_text_diff, pairs) * 1000
+        stall_inline = asyncio.run(loop_stall(inline, pairs)) * 1000
+        stall_thread = asyncio.run(loop_stall(threaded, pairs)) * 1000
+        print(f"{size:>6} {old_ms:>9.2f} ms {new_ms:>9.2f} ms {stall_inline:>10.2f} ms {stall_thread:>10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
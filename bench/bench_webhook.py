@@ -0,0 +1,118 @@
+"""
+Webhook: время ответа Telegram (ack) и время до хендлера на записанных апдейтах.
+Заодно проверяет, что запрос без секрета получает 401.
+
+    python bench/bench_webhook.py [N]
+"""
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import time
+
+os.environ.setdefault("WEBHOOK_URL", "https://bench.invalid")
+
+from _setup import bot  # noqa: E402
+
+from aiogram import Bot, Dispatcher  # noqa: E402
+from aiohttp import ClientSession  # noqa: E402
+
+# Апдейты в том виде, в каком их присылает Telegram
+RECORDED_UPDATES = [
+    {
+        "message": {
+            "message_id": 10,
+            "date": 1760000000,
+            "chat": {"id": 555, "type": "private", "first_name": "Bench"},
+            "from": {"id": 555, "is_bot": False, "first_name": "Bench"},
+            "text": "привет",
+        },
+    },
+    {
+        "business_message": {
+            "message_id": 11,
+            "date": 1760000000,
+            "business_connection_id": "bc-bench",
+            "chat": {"id": 777, "type": "private", "first_name": "Peer"},
+            "from": {"id": 777, "is_bot": False, "first_name": "Peer"},
+            "text": "сообщение в бизнес-чат",
+        },
+    },
+    {
+        "edited_business_message": {
+            "message_id": 11,
+            "date": 1760000000,
+            "edit_date": 1760000005,
+            "business_connection_id": "bc-bench",
+            "chat": {"id": 777, "type": "private", "first_name": "Peer"},
+            "from": {"id": 777, "is_bot": False, "first_name": "Peer"},
+            "text": "сообщение в бизнес-чат (изменено)",
+        },
+    },
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run(n: int) -> None:
+    dp = Dispatcher()
+    tg = Bot("123456:bench")
+    received: dict = {}
+
+    async def on_update(event) -> None:
+        received[event.message_id, event.date.timestamp()] = time.perf_counter()
+
+    dp.message.register(on_update)
+    dp.business_message.register(on_update)
+    dp.edited_business_message.register(on_update)
+
+    port = free_port()
+    await bot.start_http_server(port, dp=dp, bot=tg)
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET}
+
+    acks, deliveries = [], []
+    async with ClientSession() as http:
+        async with http.post(url, json={"update_id": 0, **RECORDED_UPDATES[0]}) as resp:
+            assert resp.status == 401, f"без секрета ожидался 401, получен {resp.status}"
+
+        for i in range(n):
+            update = dict(RECORDED_UPDATES[i % len(RECORDED_UPDATES)])
+            kind = next(k for k in update)
+            update[kind] = {**update[kind], "message_id": 1000 + i}
+            started = time.perf_counter()
+            async with http.post(url, json={"update_id": i + 1, **update}, headers=headers) as resp:
+                assert resp.status == 200, resp.status
+            acks.append(time.perf_counter() - started)
+            key = (1000 + i, float(update[kind]["date"]))
+            while key not in received:
+                await asyncio.sleep(0)
+            deliveries.append(received[key] - started)
+
+    await tg.session.close()
+
+    def report(name: str, values: list) -> None:
+        values = sorted(values)
+        print(
+            f"  {name}: p50 {statistics.median(values) * 1000:.2f} ms, "
+            f"p95 {values[int(0.95 * len(values))] * 1000:.2f} ms, "
+            f"max {values[-1] * 1000:.2f} ms"
+        )
+
+    print(f"{n} webhook updates (401 without secret: ok)")
+    report("ack", acks)
+    report("to handler", deliveries)
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    asyncio.run(run(n))
+
+
+if __name__ == "__main__":
+    main()
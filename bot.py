@@ -1,23 +1,33 @@
 import asyncio
+import codecs
 import json
 import logging
 import os
+import secrets
 import random
 import io
 import re
 import time
 import hmac
+import gzip
 import hashlib
 import sqlite3
+import tempfile
+import threading
+
+from functools import partial
+from itertools import groupby
 
 from urllib.parse import parse_qsl
 from config import *
 
 DB_PATH = os.getenv("DB_PATH", "events.db")
 
-_db = sqlite3.connect("events.db", check_same_thread=False)
+_db = sqlite3.connect(DB_PATH, check_same_thread=False)
 _db.row_factory = sqlite3.Row
 _cur = _db.cursor()
+# WAL: читатели (пул для API) не блокируют единственного писателя и наоборот
+_cur.execute("PRAGMA journal_mode=WAL")
 
 _cur.execute("""
 CREATE TABLE IF NOT EXISTS events (
@@ -31,15 +41,81 @@ CREATE TABLE IF NOT EXISTS events (
 )
 """)
 
+# Ссылка правки на версию сообщения (см. message_versions); у таких событий тексты
+# в events не хранятся, а собираются из цепочки версий при чтении
+_event_columns = {col["name"] for col in _cur.execute("PRAGMA table_info(events)").fetchall()}
+for _column in ("chat_id", "message_id", "version"):
+    if _column not in _event_columns:
+        _cur.execute(f"ALTER TABLE events ADD COLUMN {_column} INTEGER")
+
+# Цепочки версий текста сообщений: первая версия и периодические снимки целиком ('full'),
+# остальные — дельтой к предыдущей ('delta', JSON-список операций)
+_cur.execute("""
+CREATE TABLE IF NOT EXISTS message_versions (
+    owner_id   INTEGER,
+    chat_id    INTEGER,
+    message_id INTEGER,
+    version    INTEGER,
+    kind       TEXT,
+    data       TEXT,
+    timestamp  INTEGER,
+    PRIMARY KEY (owner_id, chat_id, message_id, version)
+)
+""")
+
 # Таблица для отслеживания ботов, которых видели впервые
 _cur.execute("""
 CREATE TABLE IF NOT EXISTS seen_bots (
-    bot_id          INTEGER PRIMARY KEY,          -- id бота (Telegram user id)
+    bot_id          TEXT PRIMARY KEY,              -- ключ бота: bot_<username в нижнем регистре>
     first_seen_at   INTEGER,                       -- unix timestamp первого появления
     first_seen_chat INTEGER                        -- в каком чате (owner_id) впервые увидели
 )
 """)
 
+# Старая схема объявляла bot_id как INTEGER PRIMARY KEY, и вставка текстовых ключей
+# падала с "datatype mismatch". Переносим таблицу на TEXT один раз.
+if any(
+    col["name"] == "bot_id" and col["type"].upper() == "INTEGER"
+    for col in _cur.execute("PRAGMA table_info(seen_bots)").fetchall()
+):
+    _cur.executescript("""
+    ALTER TABLE seen_bots RENAME TO seen_bots_old;
+    CREATE TABLE seen_bots (
+        bot_id          TEXT PRIMARY KEY,
+        first_seen_at   INTEGER,
+        first_seen_chat INTEGER
+    );
+    INSERT INTO seen_bots SELECT CAST(bot_id AS TEXT), first_seen_at, first_seen_chat FROM seen_bots_old;
+    DROP TABLE seen_bots_old;
+    """)
+
+# Холодный слой кэша сообщений: переживает перезапуск, чтобы edit/delete находили старую версию
+_cur.execute("""
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id                INTEGER,
+    message_id             INTEGER,
+    content                TEXT,
+    user                   TEXT,
+    business_connection_id TEXT,
+    media_type             TEXT,
+    media_file_id          TEXT,
+    saved_at               INTEGER,
+    PRIMARY KEY (chat_id, message_id)
+)
+""")
+_cur.execute(
+    "CREATE INDEX IF NOT EXISTS idx_messages_bc_saved ON messages (business_connection_id, saved_at)"
+)
+
+# Индекс подписчиков REQUIRED_CHANNEL, который ведётся по апдейтам chat_member
+_cur.execute("""
+CREATE TABLE IF NOT EXISTS channel_members (
+    user_id    INTEGER PRIMARY KEY,
+    is_member  INTEGER,
+    updated_at INTEGER
+)
+""")
+
 _cur.execute("""
 CREATE TABLE IF NOT EXISTS scam_bots (
     bot_id TEXT PRIMARY KEY,
@@ -49,17 +125,32 @@ CREATE TABLE IF NOT EXISTS scam_bots (
 )
 """)
 
+# Данные кнопок модерации: в callback_data уходит только короткий токен
+_cur.execute("""
+CREATE TABLE IF NOT EXISTS callback_payloads (
+    token      TEXT PRIMARY KEY,
+    payload    TEXT,            -- JSON-список полей
+    expires_at INTEGER
+)
+""")
+
+# Keyset-пагинация /api/messages: WHERE owner_id = ? ORDER BY timestamp, id
+_cur.execute("CREATE INDEX IF NOT EXISTS idx_events_owner_ts_id ON events (owner_id, timestamp, id)")
+
 _db.commit()
 
 from html import escape
+from collections import OrderedDict, deque
 from typing import Any, Dict, List, Optional, Tuple
 from difflib import SequenceMatcher
 from aiohttp import web
 from pathlib import Path
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import (
     BotCommand,
@@ -74,9 +165,21 @@ from aiogram.types import (
     WebAppInfo,
 )
 
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
 from config import BOT_TOKEN, REQUIRED_CHANNEL, REQUIRED_CHANNEL_URL, WEBAPP_URL
+import config as _config
 
-LIVE_CLIENTS: dict[int, list[web.StreamResponse]] = {}
+# Старые config.py без webhook-настроек продолжают работать через polling
+WEBHOOK_URL = getattr(_config, "WEBHOOK_URL", os.getenv("WEBHOOK_URL", ""))
+WEBHOOK_SECRET = getattr(_config, "WEBHOOK_SECRET", os.getenv("WEBHOOK_SECRET", ""))
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # Без секрета любой может прислать апдейт от имени OWNER_ID — генерируем
+    # свой на каждый запуск, set_webhook передаёт его Telegram
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+
+LIVE_CLIENTS: dict[int, list["SSEClient"]] = {}
 
 
 logging.basicConfig(level=logging.INFO)
@@ -110,106 +213,96 @@ def switch_layout(text: str) -> str:
 def is_kawaii(user_id: Optional[int]) -> bool:
     return bool(user_id and KAWAII_MODE.get(user_id))
 
-def verify_telegram_init_data(init_data: str, bot_token: str) -> bool:
+# ========= ПРОВЕРКА initData MINI APP =========
+# Подпись считается по ключу HMAC-SHA256("WebAppData", BOT_TOKEN), ключ вычисляем один раз.
+# Уже проверенные строки initData кэшируются до истечения auth_date + INIT_DATA_MAX_AGE,
+# так что повторные запросы дашборда стоят одного поиска в словаре.
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", "86400"))
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "4096"))
+
+_INIT_DATA_SECRETS: Dict[str, bytes] = {}
+# initData -> (user_id, expires_at); ключ — вся строка, а не hash, иначе подпись
+# можно было бы «переклеить» на изменённые поля. LRU: попадание переносит запись в конец
+_INIT_DATA_CACHE: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+INIT_DATA_STATS: Dict[str, int] = {"hits": 0, "verified": 0, "rejected": 0, "expired": 0}
+
+
+def _init_data_secret(bot_token: str) -> bytes:
+    secret = _INIT_DATA_SECRETS.get(bot_token)
+    if secret is None:
+        secret = _INIT_DATA_SECRETS[bot_token] = hmac.new(
+            b"WebAppData", bot_token.encode(), hashlib.sha256
+        ).digest()
+    return secret
+
+
+def verify_init_data(init_data: str, bot_token: str = BOT_TOKEN) -> Optional[int]:
     """
-    Проверяет, что запрос пришёл от Telegram Mini App
+    Проверяет initData Telegram Mini App и возвращает id подписанного пользователя
+    (None — подпись неверна, данные просрочены или в них нет пользователя)
     """
+    if not init_data:
+        return None
+    now = time.time()
+    cached = _INIT_DATA_CACHE.get(init_data)
+    if cached is not None:
+        user_id, expires_at = cached
+        if expires_at > now:
+            INIT_DATA_STATS["hits"] += 1
+            _INIT_DATA_CACHE.move_to_end(init_data)
+            return user_id
+        del _INIT_DATA_CACHE[init_data]
+        INIT_DATA_STATS["expired"] += 1
+        return None
+
     try:
         data = dict(parse_qsl(init_data, strict_parsing=True))
         received_hash = data.pop("hash")
 
         data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(data.items()))
 
-        secret_key = hashlib.sha256(bot_token.encode()).digest()
         calculated_hash = hmac.new(
-            secret_key,
+            _init_data_secret(bot_token),
             data_check_string.encode(),
             hashlib.sha256
         ).hexdigest()
 
-        return hmac.compare_digest(calculated_hash, received_hash)
+        if not hmac.compare_digest(calculated_hash, received_hash):
+            raise ValueError("bad hash")
+        expires_at = int(data["auth_date"]) + INIT_DATA_MAX_AGE
+        user_id = int(json.loads(data["user"])["id"])
     except Exception:
-        return False
-
-async def api_messages(request: web.Request):
-    data = await request.json()
-
-    init_data = data.get("initData")
-    user_id = data.get("user_id")
-
-    # 🔐 Защита
-    if not init_data or not verify_telegram_init_data(init_data, BOT_TOKEN):
-        return web.json_response({"error": "unauthorized"}, status=403)
-
-    cur.execute(
-        """
-        SELECT event_type, author, content, old_content, timestamp
-        FROM events
-        WHERE owner_id = ?
-        ORDER BY timestamp DESC
-        LIMIT 500
-        """,
-        (user_id,)
-    )
-
-    rows = cur.fetchall()
-
-    return web.json_response({
-        "messages": [
-            {
-                "type": r["event_type"],
-                "author": r["author"],
-                "content": r["content"],
-                "old_content": r["old_content"],
-                "timestamp": r["timestamp"],
-            }
-            for r in rows
-        ]
-    })
-
-async def api_events_stream(request: web.Request):
-    params = request.rel_url.query
-    user_id = int(params.get("user_id", 0))
-    init_data = params.get("initData")
-
-    if not verify_telegram_init_data(init_data, BOT_TOKEN):
-        return web.Response(status=403)
-
-    resp = web.StreamResponse(
-        status=200,
-        headers={
-            "Content-Type": "text/event-stream",
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
-    )
-
-    await resp.prepare(request)
+        INIT_DATA_STATS["rejected"] += 1
+        return None
 
-    LIVE_CLIENTS.setdefault(user_id, []).append(resp)
+    if expires_at <= now:
+        INIT_DATA_STATS["expired"] += 1
+        return None
 
-    try:
-        while True:
-            await asyncio.sleep(60)
-    except asyncio.CancelledError:
-        pass
-    finally:
-        LIVE_CLIENTS[user_id].remove(resp)
+    INIT_DATA_STATS["verified"] += 1
+    _INIT_DATA_CACHE[init_data] = (user_id, expires_at)
+    if len(_INIT_DATA_CACHE) > INIT_DATA_CACHE_SIZE:
+        _INIT_DATA_CACHE.popitem(last=False)
+    return user_id
 
-    return resp
 
 async def api_events_stream_handler(request: web.Request) -> web.StreamResponse:
-    user_id = request.rel_url.query.get("user_id")
+    global _SSE_OPEN_STREAMS
     init_data = request.rel_url.query.get("initData")
 
-    if not user_id or not init_data:
+    if not init_data:
         return web.Response(status=400)
 
-    if not verify_telegram_init_data(init_data, BOT_TOKEN):
+    # Поток принадлежит пользователю из подписанных данных, а не из параметров запроса
+    user_id = verify_init_data(init_data)
+    if user_id is None:
         return web.Response(status=403)
 
     try:
-        user_id = int(user_id)
+        # EventSource сам шлёт Last-Event-ID при переподключении; app.js, пересоздавая
+        # соединение, передаёт его параметром last_event_id
+        last_event_id = request.headers.get("Last-Event-ID") or request.rel_url.query.get("last_event_id")
+        last_event_id = int(last_event_id) if last_event_id else None
     except Exception:
         return web.Response(status=400)
 
@@ -221,15 +314,37 @@ async def api_events_stream_handler(request: web.Request) -> web.StreamResponse:
         }
     )
 
-    await resp.prepare(request)
-
-    LIVE_CLIENTS.setdefault(user_id, []).append(resp)
+    # Слот занимаем до первого await, иначе одновременные подключения проходят проверку все сразу
+    if _SSE_OPEN_STREAMS >= SSE_MAX_STREAMS:
+        SSE_STATS["rejected"] += 1
+        # EventSource не видит статус и заголовки ответа — срок повтора передаём событием
+        resp.headers["Retry-After"] = str(SSE_BUSY_RETRY_AFTER)
+        await resp.prepare(request)
+        await resp.write(_sse_busy_frame())
+        return resp
+    _SSE_OPEN_STREAMS += 1
 
     try:
-        while True:
-            await asyncio.sleep(60)
+        await resp.prepare(request)
+
+        # Хвост из буфера collect_replay берёт уже после своего последнего await,
+        # и регистрация идёт сразу за ним — события не теряются. Строка, прочитанная из БД
+        # до того, как колбэк коммита её опубликовал, придёт и live: offer отбросит её по id
+        if last_event_id is not None:
+            replay, replayed_until = await collect_replay(user_id, last_event_id)
+        else:
+            replay, replayed_until = [], 0
+        client = SSEClient(user_id, resp)
+        register_live_client(client)
+        client.preload(replay, replayed_until)
+
+        try:
+            await client.run()
+        finally:
+            client.close()
+            unregister_live_client(client)
     finally:
-        LIVE_CLIENTS[user_id].remove(resp)
+        _SSE_OPEN_STREAMS -= 1
 
     return resp
 
@@ -262,6 +377,224 @@ def get_prank_inline_kb() -> InlineKeyboardMarkup:
         ]
     )
 
+# ========= СКАМ-БОТЫ: БЛОКЛИСТ =========
+# username (нижний регистр, без @) -> причина. Сообщение проверяется по кандидатам из
+# extract_bot_candidates — это в разы быстрее автомата Ахо-Корасик по всему блоклисту
+# (bench/bench_scam_match.py)
+SCAM_BOTS: Dict[str, str] = {}
+# Не повторять алерт про того же бота в том же чате чаще, чем раз в SCAM_ALERT_COOLDOWN.
+# Порядок вставки = порядок времени, устаревшие записи снимаются с начала
+SCAM_ALERT_COOLDOWN = 3600
+_SCAM_ALERTS_SENT: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+
+
+def _scam_username(bot_key: str) -> str:
+    name = bot_key.lower().lstrip("@")
+    for prefix in ("bot_", "mention_"):
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return name
+
+
+def load_scam_bots() -> None:
+    """Загрузить блоклист scam_bots в память."""
+    _cur.execute("SELECT bot_id, reason FROM scam_bots")
+    for row in _cur.fetchall():
+        SCAM_BOTS[_scam_username(row["bot_id"])] = row["reason"] or ""
+    logging.info(f"Loaded {len(SCAM_BOTS)} scam bots from DB")
+
+
+def add_scam_bot(bot_key: str, reason: str) -> None:
+    """Добавить бота в блоклист: сразу виден в проверках."""
+    SCAM_BOTS[_scam_username(bot_key)] = reason
+
+
+def find_scam_bots(message: types.Message) -> set:
+    """Вернуть username'ы скам-ботов, которые встречаются в сообщении."""
+    if not SCAM_BOTS:
+        return set()
+    # Те же кандидаты, что и для проверки новых ботов — считаются один раз на сообщение
+    return {name for name in extract_bot_candidates(message) if name in SCAM_BOTS}
+
+
+def _prune_scam_alerts(now: float) -> None:
+    while _SCAM_ALERTS_SENT:
+        key, sent_at = next(iter(_SCAM_ALERTS_SENT.items()))
+        if now - sent_at < SCAM_ALERT_COOLDOWN:
+            break
+        del _SCAM_ALERTS_SENT[key]
+
+
+async def check_scam_bots(message: types.Message) -> set:
+    """Проверить сообщение по блоклисту и сразу предупредить чат. Возвращает найденные username'ы."""
+    hits = find_scam_bots(message)
+    now = time.monotonic()
+    if hits:
+        _prune_scam_alerts(now)
+    for name in hits:
+        alert_key = (message.chat.id, name)
+        if alert_key in _SCAM_ALERTS_SENT:
+            continue
+        _SCAM_ALERTS_SENT[alert_key] = now
+        logging.info(f"[SCAM] Найден скам-бот @{name} в чате {message.chat.id}")
+        send_later(
+            partial(
+                message.bot.send_message,
+                chat_id=message.chat.id,
+                text=(
+                    f"🚫 Внимание! Бот @{name} помечен командой EternalMOD как скам.\n\n"
+                    f"Не переходите по ссылкам, не передавайте подарки и не подключайте его.\n"
+                    f"Если вам что-то предлагают через этого бота — напишите в @savemod_chat."
+                ),
+                disable_web_page_preview=True,
+                parse_mode=None,
+            ),
+            chat_id=message.chat.id,
+            description=f"[SCAM] алерт в чат {message.chat.id}",
+        )
+    return hits
+
+
+# Индекс seen_bots в памяти: проверка «видели ли бота» не ходит в SQLite
+SEEN_BOTS: set = set()
+
+
+def load_seen_bots() -> None:
+    """Загрузить ключи seen_bots из БД в память."""
+    _cur.execute("SELECT bot_id FROM seen_bots")
+    SEEN_BOTS.update(row["bot_id"] for row in _cur.fetchall())
+    logging.info(f"Loaded {len(SEEN_BOTS)} seen bots from DB")
+
+
+# Username бота: 5–32 символа + bot/robot на конце (как в Telegram)
+_BOT_USERNAME_RE = re.compile(r'[a-zA-Z0-9_]{5,32}(?:_?bot|_?robot)', re.IGNORECASE)
+# Фолбэк, если entities нет: @упоминания и t.me-ссылки прямо по тексту. Паттерны начинаются
+# с литерала — re ищет его быстрым поиском, а не пробует альтернативы в каждой позиции
+_BOT_MENTION_RE = re.compile(r'@([a-zA-Z0-9_]{5,32}(?:_?bot|_?robot))\b', re.IGNORECASE)
+_BOT_LINK_RE = re.compile(r'\.me/([a-zA-Z0-9_]{5,32}(?:_?bot|_?robot))\b', re.IGNORECASE)
+_BOT_ENTITY_TYPES = frozenset({"mention", "text_mention", "url", "text_link"})
+_NO_BOT_CANDIDATES: frozenset = frozenset()
+_TME_LINK_RE = re.compile(r'^(?:https?://)?(?:www\.)?(?:t|telegram)\.me/([a-zA-Z0-9_]+)', re.IGNORECASE)
+# (chat_id, message_id, edit_date) -> кандидаты; одно сообщение проверяется несколькими хендлерами
+_BOT_CANDIDATES_CACHE: "OrderedDict[Tuple[int, int, Any], frozenset]" = OrderedDict()
+_BOT_CANDIDATES_CACHE_MAX = 2048
+
+
+def _bot_username_from_link(url: str) -> Optional[str]:
+    match = _TME_LINK_RE.match(url)
+    if match and _BOT_USERNAME_RE.fullmatch(match.group(1)):
+        return match.group(1).lower()
+    return None
+
+
+def _is_tme_host(text: str, end: int) -> bool:
+    """Перед ".me/" на позиции end стоит хост t или telegram."""
+    if text.endswith(("t", "T"), 0, end):
+        return end < 2 or not text[end - 2].isalnum()
+    return text[max(0, end - 8):end].lower() == "telegram"
+
+
+def _find_bot_names_in_text(text: str) -> List[str]:
+    names = [m.lower() for m in _BOT_MENTION_RE.findall(text)] if "@" in text else []
+    if ".me/" in text:
+        names.extend(
+            m.group(1).lower() for m in _BOT_LINK_RE.finditer(text) if _is_tme_host(text, m.start())
+        )
+    return names
+
+
+def extract_bot_candidates(message: types.Message) -> frozenset:
+    """Собрать кандидатов на "бот" (username в нижнем регистре) из автора, форварда и entities."""
+    text = message.text or message.caption
+    entities = message.entities if message.text else message.caption_entities
+    # Обычное сообщение без упоминаний и ссылок: ни разбора текста, ни записи в мемо
+    if entities:
+        scan_text = any(entity.type in _BOT_ENTITY_TYPES for entity in entities)
+    else:
+        scan_text = bool(text) and ("@" in text or ".me/" in text)
+    if not scan_text and not (
+        (message.from_user and message.from_user.is_bot)
+        or message.forward_from
+        or message.via_bot
+        or message.forward_sender_name
+    ):
+        return _NO_BOT_CANDIDATES
+
+    cache_key = (message.chat.id, message.message_id, message.edit_date)
+    cached = _BOT_CANDIDATES_CACHE.get(cache_key)
+    if cached is not None:
+        _BOT_CANDIDATES_CACHE.move_to_end(cache_key)
+        return cached
+
+    bot_candidates = set()
+
+    # 1. Прямое сообщение от бота
+    if message.from_user and message.from_user.is_bot and message.from_user.username:
+        bot_candidates.add(message.from_user.username.lower())
+
+    # 2. Форвард от бота
+    if message.forward_from and message.forward_from.is_bot and message.forward_from.username:
+        bot_candidates.add(message.forward_from.username.lower())
+
+    # 2a. Отправлено через inline-бота
+    if message.via_bot and message.via_bot.username:
+        bot_candidates.add(message.via_bot.username.lower())
+
+    # 3. Упоминания и ссылки — по entities (Telegram уже разметил их), без прохода регуляркой по тексту
+    if scan_text and entities:
+        # Смещения entities — в UTF-16; у ASCII-текста они совпадают с индексами строки,
+        # иначе текст кодируется один раз на сообщение. codecs.utf_16_le_decode — прямой
+        # вызов C-кодека, bytes.decode идёт через реестр кодеков
+        ascii_text = text.isascii()
+        utf16 = None
+        for entity in entities:
+            kind = entity.type
+            if kind == "text_mention":
+                if entity.user and entity.user.is_bot and entity.user.username:
+                    bot_candidates.add(entity.user.username.lower())
+                continue
+            if kind == "text_link":
+                name = _bot_username_from_link(entity.url)
+                if name:
+                    bot_candidates.add(name)
+                continue
+            if kind != "mention" and kind != "url":
+                continue
+            start, end = entity.offset, entity.offset + entity.length
+            if ascii_text:
+                piece = text[start:end]
+            else:
+                if utf16 is None:
+                    utf16 = text.encode("utf-16-le")
+                piece = codecs.utf_16_le_decode(utf16[start * 2:end * 2])[0]
+            if kind == "mention":
+                # "robot" тоже кончается на "bot" — дешёвая проверка до регулярки
+                name = piece[1:]
+                if name[-3:].lower() == "bot" and _BOT_USERNAME_RE.fullmatch(name):
+                    bot_candidates.add(name.lower())
+            else:
+                name = _bot_username_from_link(piece)
+                if name:
+                    bot_candidates.add(name)
+    elif scan_text:
+        # Entities нет (например, старое сообщение из кэша) — фолбэк на регулярку
+        bot_candidates.update(_find_bot_names_in_text(text))
+
+    # 4. Скрытый форвард (имя содержит bot/robot)
+    if message.forward_sender_name:
+        name_lower = message.forward_sender_name.lower()
+        if "bot" in name_lower:
+            pseudo = name_lower.replace(" ", "_").replace(".", "")
+            if pseudo.endswith(("bot", "robot")):
+                bot_candidates.add(pseudo)
+
+    result = frozenset(bot_candidates)
+    _BOT_CANDIDATES_CACHE[cache_key] = result
+    if len(_BOT_CANDIDATES_CACHE) > _BOT_CANDIDATES_CACHE_MAX:
+        _BOT_CANDIDATES_CACHE.popitem(last=False)
+    return result
+
+
 async def warn_about_new_bot_and_offer_report(message: types.Message):
     """
     Проверяет, упоминается ли / отправляет ли сообщение бот впервые.
@@ -283,31 +616,7 @@ async def warn_about_new_bot_and_offer_report(message: types.Message):
         f"text={(message.text or message.caption or 'нет текста')[:80]!r}"
     )
 
-    # Собираем кандидатов на "бот" (username в нижнем регистре)
-    bot_candidates = set()
-
-    # 1. Прямое сообщение от бота
-    if message.from_user.is_bot and message.from_user.username:
-        bot_candidates.add(message.from_user.username.lower())
-
-    # 2. Форвард от бота
-    if message.forward_from and message.forward_from.is_bot and message.forward_from.username:
-        bot_candidates.add(message.forward_from.username.lower())
-
-    # 3. Упоминания в тексте (@name_bot / @name_robot / @name_bot_)
-    if message.text or message.caption:
-        text = message.text or message.caption or ""
-        mentions = re.findall(r'@([a-zA-Z0-9_]{5,32}(?:_?bot|_?robot))\b', text, re.IGNORECASE)
-        for m in mentions:
-            bot_candidates.add(m.lower())
-
-    # 4. Скрытый форвард (имя содержит bot/robot)
-    if message.forward_sender_name:
-        name_lower = message.forward_sender_name.lower()
-        if "bot" in name_lower or "robot" in name_lower:
-            pseudo = name_lower.replace(" ", "_").replace(".", "")
-            if pseudo.endswith(("bot", "robot")):
-                bot_candidates.add(pseudo)
+    bot_candidates = extract_bot_candidates(message)
 
     if not bot_candidates:
         logging.info("[NEW_BOT] Кандидаты не найдены → пропуск")
@@ -317,19 +626,21 @@ async def warn_about_new_bot_and_offer_report(message: types.Message):
     for uname_lower in bot_candidates:
         key = f"bot_{uname_lower}"
 
-        # Уже видели?
-        _cur.execute("SELECT 1 FROM seen_bots WHERE bot_id = ?", (key,))
-        if _cur.fetchone():
+        # Известный скам — про него уже предупредил check_scam_bots
+        if uname_lower in SCAM_BOTS:
+            continue
+
+        # Уже видели? (проверка в памяти, без SQLite)
+        if key in SEEN_BOTS:
             logging.info(f"[NEW_BOT] Уже видели {uname_lower} → пропуск")
             continue
 
-        # Новый → запоминаем
-        now = int(time.time())
-        _cur.execute(
+        # Новый → запоминаем (в БД запишет фоновый writer)
+        SEEN_BOTS.add(key)
+        queue_db_write(
             "INSERT OR IGNORE INTO seen_bots (bot_id, first_seen_at, first_seen_chat) VALUES (?, ?, ?)",
-            (key, now, message.chat.id)
+            (key, int(time.time()), message.chat.id),
         )
-        _db.commit()
 
         logging.info(f"[NEW_BOT] Новый бот добавлен в БД: {uname_lower}")
 
@@ -351,71 +662,24 @@ async def warn_about_new_bot_and_offer_report(message: types.Message):
             [
                 InlineKeyboardButton(
                     text="Отправить на проверку",
-                    callback_data=f"report_new_bot_{key}_{message.chat.id}"
+                    callback_data=pack_callback("rp", store_callback_payload(key, message.chat.id))
                 )
             ]
         ])
 
-        try:
-            await message.bot.send_message(
+        send_later(
+            partial(
+                message.bot.send_message,
                 chat_id=message.chat.id,           # ← именно сюда пришло сообщение
                 text=warning_text,
                 reply_markup=kb,
                 disable_web_page_preview=True,
-                parse_mode=None
-            )
-            logging.info(f"[NEW_BOT] Предупреждение успешно отправлено в чат {message.chat.id}")
-        except Exception as e:
-            logging.error(f"[NEW_BOT] Ошибка отправки в чат {message.chat.id}: {e}")
-
-async def on_report_new_bot(callback: types.CallbackQuery):
-    if not callback.data.startswith("report_new_bot_"):
-        return
-
-    parts = callback.data.split("_")
-    if len(parts) < 4:
-        await callback.answer("Ошибка данных", show_alert=True)
-        return
-
-    reported_bot_id = int(parts[3])
-    chat_id = int(parts[4])  # чат владельца
-
-    # Получаем информацию о боте (можно расширить)
-    bot_username = "неизвестно"
-    try:
-        bot_user = await callback.bot.get_chat(reported_bot_id)
-        bot_username = bot_user.username or f"ID {reported_bot_id}"
-    except:
-        pass
-
-    # Уведомление тебе (админу)
-    admin_text = (
-        f"📩 Новая проверка бота от пользователя {chat_id}\n\n"
-        f"Бот: @{bot_username} (ID: {reported_bot_id})\n"
-        f"Чат владельца: {chat_id}\n"
-        f"Время: {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        f"Дальше решай сам: безопасен / скам / забанить и т.д."
-    )
-
-    # Можно добавить кнопки, если хочешь автоматизировать решение
-    # admin_kb = InlineKeyboardMarkup(inline_keyboard=[
-    #     [
-    #         InlineKeyboardButton("Одобрить", callback_data=f"approve_bot_{reported_bot_id}_{chat_id}"),
-    #         InlineKeyboardButton("Скам / Заблокировать", callback_data=f"block_bot_{reported_bot_id}_{chat_id}"),
-    #     ]
-    # ])
-
-    try:
-        await callback.bot.send_message(
-            OWNER_ID,
-            admin_text,
-            # reply_markup=admin_kb,   # раскомментируй, если нужны кнопки
-            disable_web_page_preview=True
+                parse_mode=None,
+            ),
+            chat_id=message.chat.id,
+            description=f"[NEW_BOT] предупреждение в чат {message.chat.id}",
         )
-        await callback.answer("Бот отправлен на проверку!")
-    except Exception as e:
-        logging.error(f"Ошибка отправки админу: {e}")
-        await callback.answer("Не удалось отправить на проверку", show_alert=True)
+
 
 async def cmd_prank_menu(message: types.Message) -> None:
     if not await require_subscription_message(message):
@@ -506,7 +770,7 @@ async def handle_dot_command(message: types.Message) -> bool:
         # Если reply_to_message есть, но текст недоступен, попробуем получить из кэша
         if message.reply_to_message:
             reply_key = (message.reply_to_message.chat.id, message.reply_to_message.message_id)
-            cached = MESSAGE_LOG.get(reply_key)
+            cached = await MESSAGE_LOG.get(reply_key)
             if cached and cached.get("content"):
                 result = switch_layout(cached["content"])
                 await message.answer(result, reply_markup=MAIN_KEYBOARD)
@@ -562,7 +826,8 @@ async def handle_dot_command(message: types.Message) -> bool:
         user_id = message.from_user.id
         chat_id = message.chat.id
         
-        # Проверяем подписку
+        # Проверяем подписку (мимо кэша — это тестовая команда)
+        invalidate_subscription(user_id)
         is_sub = await is_subscribed(message.bot, user_id)
         
         if is_sub:
@@ -779,10 +1044,210 @@ DARK_ROFL_LINES: List[str] = [
     "Черный юмор, он как дети антипрививочников - никогда ее стареет"
 ]
 
-MESSAGE_LOG: Dict[Tuple[int, int], Dict[str, str]] = {}
+class MessageCache:
+    """
+    Ограниченный кэш сообщений (chat_id, message_id) -> данные.
+    LRU-вытеснение по числу записей и примерному объёму, плюс TTL на запись.
+    get/set — O(1), как у обычного dict.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (expires_at, size, value)
+        self._data: "OrderedDict[Tuple[int, int], Tuple[float, int, Dict[str, Any]]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _size_of(value: Dict[str, Any]) -> int:
+        # Грубая оценка: строки + фиксированный оверхед на запись
+        return 128 + sum(len(v) for v in value.values() if isinstance(v, str))
+
+    def get(self, key: Tuple[int, int], default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, size, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self._bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key: Tuple[int, int], value: Dict[str, Any]) -> None:
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        size = self._size_of(value)
+        self._data[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+MESSAGE_CACHE_MAX_ENTRIES = int(os.getenv("MESSAGE_CACHE_MAX_ENTRIES", "100000"))
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_MB", "128")) * 1024 * 1024
+MESSAGE_CACHE_TTL = int(os.getenv("MESSAGE_CACHE_TTL_HOURS", "72")) * 3600
+
+class MessageStore:
+    """
+    Двухуровневое хранилище сообщений: горячий MessageCache в памяти
+    и холодная таблица messages в SQLite (запись пачками через фоновый writer).
+    Промах в памяти — точечный запрос по первичному ключу (chat_id, message_id).
+    """
+
+    _FIELDS = ("content", "user", "business_connection_id", "media_type", "media_file_id")
+    _UPSERT_SQL = """
+        INSERT OR REPLACE INTO messages
+        (chat_id, message_id, content, user, business_connection_id, media_type, media_file_id, saved_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    def __init__(self, hot: MessageCache) -> None:
+        self.hot = hot
+        self.cold_hits = 0
+        self.cold_misses = 0
+
+    async def get(self, key: Tuple[int, int], default: Any = None) -> Any:
+        value = self.hot.get(key)
+        if value is not None:
+            return value
+        value = await READ_POOL.run(self._load_cold, key)
+        if value is None:
+            self.cold_misses += 1
+            return default
+        self.cold_hits += 1
+        self.hot[key] = value
+        return value
+
+    def __setitem__(self, key: Tuple[int, int], value: Dict[str, Any]) -> None:
+        self.hot[key] = value
+        queue_db_write(
+            self._UPSERT_SQL,
+            (key[0], key[1], *(value.get(f) for f in self._FIELDS), int(time.time())),
+        )
+
+    def __len__(self) -> int:
+        return len(self.hot)
+
+    def _load_cold(self, conn: sqlite3.Connection, key: Tuple[int, int]) -> Optional[Dict[str, Any]]:
+        """Точечное чтение из холодного слоя (в потоке READ_POOL)."""
+        try:
+            row = conn.execute(
+                "SELECT content, user, business_connection_id, media_type, media_file_id "
+                "FROM messages WHERE chat_id = ? AND message_id = ?",
+                key,
+            ).fetchone()
+        except Exception as e:
+            logging.error(f"MessageStore: ошибка чтения из БД: {e}")
+            return None
+        return {f: row[f] for f in self._FIELDS} if row else None
+
+    def prune(self, max_age: int) -> int:
+        """Удалить из холодного слоя записи старше max_age секунд."""
+        _cur.execute("DELETE FROM messages WHERE saved_at < ?", (int(time.time()) - max_age,))
+        _db.commit()
+        return _cur.rowcount
+
+    def warm_up(self, per_connection: int) -> int:
+        """Загрузить в память последние per_connection сообщений каждого бизнес-подключения."""
+        if per_connection <= 0:
+            return 0
+        _cur.execute(
+            """
+            SELECT chat_id, message_id, content, user, business_connection_id, media_type, media_file_id
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY business_connection_id ORDER BY saved_at DESC
+                ) AS rn
+                FROM messages
+                WHERE business_connection_id IS NOT NULL
+            )
+            WHERE rn <= ?
+            ORDER BY saved_at ASC
+            """,
+            (per_connection,),
+        )
+        count = 0
+        for row in _cur.fetchall():
+            self.hot[(row["chat_id"], row["message_id"])] = {f: row[f] for f in self._FIELDS}
+            count += 1
+        return count
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.hot.stats(), "cold_hits": self.cold_hits, "cold_misses": self.cold_misses}
+
+
+# Сколько последних сообщений на бизнес-подключение поднимать в память при старте (0 — не поднимать)
+MESSAGE_WARM_START = int(os.getenv("MESSAGE_WARM_START", "200"))
+MESSAGE_STORE_RETENTION = int(os.getenv("MESSAGE_STORE_RETENTION_DAYS", "30")) * 86400
+# Как часто чистить холодный слой во время работы (не только при старте)
+MESSAGE_STORE_PRUNE_INTERVAL = int(os.getenv("MESSAGE_STORE_PRUNE_INTERVAL_MIN", "60")) * 60
+_MESSAGE_PRUNE_TASK: Optional[asyncio.Task] = None
+
+
+async def _message_prune_loop() -> None:
+    while True:
+        await asyncio.sleep(MESSAGE_STORE_PRUNE_INTERVAL)
+        # Удаление идёт через фоновый writer, как и остальные записи
+        queue_db_write(
+            "DELETE FROM messages WHERE saved_at < ?", (int(time.time()) - MESSAGE_STORE_RETENTION,)
+        )
+
+
+def start_message_pruning() -> None:
+    global _MESSAGE_PRUNE_TASK
+    if _MESSAGE_PRUNE_TASK is None:
+        _MESSAGE_PRUNE_TASK = asyncio.get_running_loop().create_task(_message_prune_loop())
+
+
+def stop_message_pruning() -> None:
+    global _MESSAGE_PRUNE_TASK
+    if _MESSAGE_PRUNE_TASK is not None:
+        _MESSAGE_PRUNE_TASK.cancel()
+        _MESSAGE_PRUNE_TASK = None
+
+MESSAGE_LOG = MessageStore(
+    MessageCache(
+        max_entries=MESSAGE_CACHE_MAX_ENTRIES,
+        max_bytes=MESSAGE_CACHE_MAX_BYTES,
+        ttl=MESSAGE_CACHE_TTL,
+    )
+)
 # business_connection_id -> {chat_id: int, owner_id: int}
 BUSINESS_LOG_CHATS: Dict[str, Dict[str, int]] = {}
 BUSINESS_CONNECTIONS_FILE = "business_connections.json"
+# Пачка подключений/отключений в пределах окна сохраняется одной записью файла
+BUSINESS_CONNECTIONS_SAVE_DELAY = float(os.getenv("BUSINESS_CONNECTIONS_SAVE_DELAY", "1.0"))
+_BUSINESS_SAVE_TASK: Optional[asyncio.Task] = None
 # Для отслеживания последнего уведомления о подписке (чтобы не спамить)
 # owner_id -> timestamp последнего уведомления
 LAST_SUBSCRIPTION_NOTIFICATION: Dict[int, float] = {} 
@@ -803,6 +1268,7 @@ def load_business_connections() -> None:
             # старый формат: { bc_id: chat_id }
             # новый формат: { bc_id: { "chat_id": int, "owner_id": int } }
             migrated: Dict[str, Dict[str, int]] = {}
+            legacy = False
             if isinstance(raw, dict):
                 for k, v in raw.items():
                     if isinstance(v, dict) and "chat_id" in v:
@@ -812,27 +1278,106 @@ def load_business_connections() -> None:
                         }
                     else:
                         # old schema (chat_id only)
+                        legacy = True
                         try:
                             migrated[str(k)] = {"chat_id": int(v), "owner_id": 0}
                         except Exception:
                             continue
             BUSINESS_LOG_CHATS = migrated
             logging.info(f"Loaded {len(BUSINESS_LOG_CHATS)} business connections from file")
+            # Старый формат переписываем один раз, чтобы не мигрировать его на каждом старте
+            if legacy:
+                save_business_connections()
         except Exception as e:
             logging.error(f"Error loading business connections: {e}")
             BUSINESS_LOG_CHATS = {}
 
 
+# Отложенная запись идёт в потоке, а при остановке flush пишет из event loop —
+# без лока две записи могли бы пересечься
+_FILE_WRITE_LOCK = threading.Lock()
+
+
+def _write_file_atomic(path: str, payload: bytes) -> None:
+    """Записать файл через временный + fsync + rename: при сбое остаётся старая или новая версия."""
+    with _FILE_WRITE_LOCK:
+        _replace_file(path, payload)
+
+
+def _replace_file(path: str, payload: bytes) -> None:
+    # У каждой записи свой временный файл в том же каталоге (rename в пределах одной ФС)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=f"{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    # rename тоже должен пережить сбой питания — синхронизируем каталог (где это возможно)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
 def save_business_connections() -> None:
-    """Сохранить бизнес-подключения в файл."""
+    """Сохранить бизнес-подключения в файл (сразу, атомарно)."""
+    try:
+        payload = json.dumps(BUSINESS_LOG_CHATS, ensure_ascii=False, separators=(",", ":")).encode()
+        _write_file_atomic(BUSINESS_CONNECTIONS_FILE, payload)
+        logging.debug(f"Saved {len(BUSINESS_LOG_CHATS)} business connections to file")
+    except Exception as e:
+        logging.error(f"Error saving business connections: {e}")
+
+
+async def _save_business_connections_later() -> None:
+    global _BUSINESS_SAVE_TASK
+    await asyncio.sleep(BUSINESS_CONNECTIONS_SAVE_DELAY)
+    _BUSINESS_SAVE_TASK = None
+    # Снимок берём в потоке цикла, а пишем на диск — в отдельном потоке
     try:
-        with open(BUSINESS_CONNECTIONS_FILE, "w", encoding="utf-8") as f:
-            json.dump(BUSINESS_LOG_CHATS, f, ensure_ascii=False, indent=2)
+        payload = json.dumps(BUSINESS_LOG_CHATS, ensure_ascii=False, separators=(",", ":")).encode()
+        await asyncio.to_thread(_write_file_atomic, BUSINESS_CONNECTIONS_FILE, payload)
         logging.debug(f"Saved {len(BUSINESS_LOG_CHATS)} business connections to file")
     except Exception as e:
         logging.error(f"Error saving business connections: {e}")
 
 
+def schedule_save_business_connections() -> None:
+    """Отложенное сохранение: все изменения за BUSINESS_CONNECTIONS_SAVE_DELAY — одной записью."""
+    global _BUSINESS_SAVE_TASK
+    if _BUSINESS_SAVE_TASK is not None:
+        return
+    try:
+        _BUSINESS_SAVE_TASK = asyncio.get_running_loop().create_task(_save_business_connections_later())
+    except RuntimeError:
+        save_business_connections()
+
+
+def flush_business_connections() -> None:
+    """Сбросить отложенное сохранение немедленно (при остановке бота)."""
+    global _BUSINESS_SAVE_TASK
+    if _BUSINESS_SAVE_TASK is None:
+        return
+    _BUSINESS_SAVE_TASK.cancel()
+    _BUSINESS_SAVE_TASK = None
+    save_business_connections()
+
+
 def get_log_chat_id(bc_id: Optional[str]) -> Optional[int]:
     if not bc_id:
         return None
@@ -884,15 +1429,151 @@ def _is_member_status(status: str) -> bool:
     return status in ("member", "administrator", "creator")
 
 
-async def is_subscribed(bot: Bot, user_id: int) -> bool:
-    """Return True if user is subscribed to REQUIRED_CHANNEL."""
+# Кэш проверки подписки: user_id -> (expires_at, is_member).
+# Отрицательный ответ живёт меньше, чтобы свежая подписка подхватывалась быстро.
+SUBSCRIPTION_TTL_POSITIVE = int(os.getenv("SUBSCRIPTION_TTL_POSITIVE", "600"))
+SUBSCRIPTION_TTL_NEGATIVE = int(os.getenv("SUBSCRIPTION_TTL_NEGATIVE", "30"))
+SUBSCRIPTION_CACHE_MAX = 50000
+_SUBSCRIPTION_CACHE: Dict[int, Tuple[float, bool]] = {}
+# Запросы get_chat_member в полёте: параллельные проверки одного юзера ждут один и тот же
+_SUBSCRIPTION_INFLIGHT: Dict[int, "asyncio.Task[bool]"] = {}
+# Запросы, устаревшие из-за invalidate_subscription: их ответ не попадает в кэш
+_STALE_SUBSCRIPTION_FETCHES: set = set()
+SUBSCRIPTION_STATS: Dict[str, int] = {
+    "hits": 0, "index_hits": 0, "misses": 0, "coalesced": 0, "api_calls": 0, "errors": 0,
+}
+
+# Локальный индекс подписчиков канала. Включать, только если бот — админ REQUIRED_CHANNEL:
+# тогда Telegram шлёт апдейты chat_member и индекс остаётся актуальным без get_chat_member.
+SUBSCRIPTION_INDEX = os.getenv("SUBSCRIPTION_INDEX", "0") == "1"
+CHANNEL_MEMBERS: Dict[int, bool] = {}
+_UPSERT_CHANNEL_MEMBER_SQL = (
+    "INSERT OR REPLACE INTO channel_members (user_id, is_member, updated_at) VALUES (?, ?, ?)"
+)
+
+
+def invalidate_subscription(user_id: int) -> None:
+    """Забыть закэшированный статус подписки (например, по кнопке «Проверить подписку»)."""
+    _SUBSCRIPTION_CACHE.pop(user_id, None)
+    # Индекс тоже: следующая проверка спросит Telegram и перезапишет запись
+    CHANNEL_MEMBERS.pop(user_id, None)
+    # Запрос, уже ушедший в Telegram, мог начаться до изменения — его ответ не кэшируем,
+    # а следующая проверка пойдёт новым запросом
+    task = _SUBSCRIPTION_INFLIGHT.pop(user_id, None)
+    if task is not None:
+        _STALE_SUBSCRIPTION_FETCHES.add(task)
+
+
+def _cache_subscription(user_id: int, is_member: bool) -> None:
+    now = time.monotonic()
+    if len(_SUBSCRIPTION_CACHE) >= SUBSCRIPTION_CACHE_MAX:
+        for uid in [u for u, (exp, _) in _SUBSCRIPTION_CACHE.items() if exp <= now]:
+            del _SUBSCRIPTION_CACHE[uid]
+        if len(_SUBSCRIPTION_CACHE) >= SUBSCRIPTION_CACHE_MAX:
+            _SUBSCRIPTION_CACHE.clear()
+    ttl = SUBSCRIPTION_TTL_POSITIVE if is_member else SUBSCRIPTION_TTL_NEGATIVE
+    _SUBSCRIPTION_CACHE[user_id] = (now + ttl, is_member)
+
+
+async def _fetch_subscription(bot: Bot, user_id: int) -> bool:
+    SUBSCRIPTION_STATS["api_calls"] += 1
     try:
         member = await bot.get_chat_member(REQUIRED_CHANNEL, user_id)
-        return _is_member_status(getattr(member, "status", ""))
     except Exception as e:
+        SUBSCRIPTION_STATS["errors"] += 1
         logging.warning("Subscription check failed: user_id=%s error=%r", user_id, e)
-        # Fail closed: if we can't check, deny access to avoid bypass
+        # Fail closed: if we can't check, deny access to avoid bypass (ошибку не кэшируем)
         return False
+    is_member = _is_member_status(getattr(member, "status", ""))
+    task = asyncio.current_task()
+    if task in _STALE_SUBSCRIPTION_FETCHES:
+        _STALE_SUBSCRIPTION_FETCHES.discard(task)
+        return is_member
+    _cache_subscription(user_id, is_member)
+    if SUBSCRIPTION_INDEX:
+        # Дальнейшие изменения придут апдейтами chat_member — можно запомнить насовсем
+        set_channel_member(user_id, is_member)
+    return is_member
+
+
+def set_channel_member(user_id: int, is_member: bool) -> None:
+    """Обновить индекс подписчиков (в памяти + SQLite через фоновый writer)."""
+    if CHANNEL_MEMBERS.get(user_id) == is_member:
+        return
+    CHANNEL_MEMBERS[user_id] = is_member
+    queue_db_write(_UPSERT_CHANNEL_MEMBER_SQL, (user_id, int(is_member), int(time.time())))
+
+
+def load_channel_members() -> None:
+    """Загрузить индекс подписчиков из БД."""
+    _cur.execute("SELECT user_id, is_member FROM channel_members")
+    for row in _cur.fetchall():
+        CHANNEL_MEMBERS[row["user_id"]] = bool(row["is_member"])
+    logging.info(f"Loaded {len(CHANNEL_MEMBERS)} channel members from DB")
+
+
+def _is_required_channel(chat: types.Chat) -> bool:
+    channel = str(REQUIRED_CHANNEL)
+    if channel.startswith("@"):
+        return (chat.username or "").lower() == channel[1:].lower()
+    try:
+        return chat.id == int(channel)
+    except ValueError:
+        return False
+
+
+async def on_channel_member(update: types.ChatMemberUpdated) -> None:
+    """Апдейт chat_member: кто-то подписался/отписался от REQUIRED_CHANNEL."""
+    if not _is_required_channel(update.chat):
+        return
+    user_id = update.new_chat_member.user.id
+    is_member = _is_member_status(update.new_chat_member.status)
+    invalidate_subscription(user_id)
+    set_channel_member(user_id, is_member)
+    logging.debug(f"Channel member update: user_id={user_id}, is_member={is_member}")
+
+
+def _forget_subscription_fetch(user_id: int, task: asyncio.Task) -> None:
+    _STALE_SUBSCRIPTION_FETCHES.discard(task)
+    # После invalidate_subscription здесь уже может лежать новый запрос
+    if _SUBSCRIPTION_INFLIGHT.get(user_id) is task:
+        del _SUBSCRIPTION_INFLIGHT[user_id]
+
+
+async def is_subscribed(bot: Bot, user_id: int) -> bool:
+    """Return True if user is subscribed to REQUIRED_CHANNEL."""
+    if SUBSCRIPTION_INDEX:
+        indexed = CHANNEL_MEMBERS.get(user_id)
+        if indexed is not None:
+            SUBSCRIPTION_STATS["index_hits"] += 1
+            return indexed
+
+    cached = _SUBSCRIPTION_CACHE.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        SUBSCRIPTION_STATS["hits"] += 1
+        return cached[1]
+    SUBSCRIPTION_STATS["misses"] += 1
+
+    task = _SUBSCRIPTION_INFLIGHT.get(user_id)
+    if task is not None:
+        SUBSCRIPTION_STATS["coalesced"] += 1
+    else:
+        task = asyncio.get_running_loop().create_task(_fetch_subscription(bot, user_id))
+        _SUBSCRIPTION_INFLIGHT[user_id] = task
+        task.add_done_callback(partial(_forget_subscription_fetch, user_id))
+    # shield: отмена одного ожидающего не должна отменять запрос остальным
+    return await asyncio.shield(task)
+
+
+def subscription_metrics() -> Dict[str, Any]:
+    stats = dict(SUBSCRIPTION_STATS)
+    lookups = stats["hits"] + stats["index_hits"] + stats["misses"]
+    stats["hit_ratio"] = round((stats["hits"] + stats["index_hits"]) / lookups, 4) if lookups else 0.0
+    # Без кэша каждая проверка была бы отдельным get_chat_member
+    stats["api_calls_saved"] = lookups - stats["api_calls"]
+    stats["cached_users"] = len(_SUBSCRIPTION_CACHE)
+    stats["indexed_users"] = len(CHANNEL_MEMBERS)
+    return stats
 
 
 async def require_subscription_message(message: types.Message) -> bool:
@@ -958,76 +1639,578 @@ def user_mention(user: Optional[types.User]) -> str:
     return f'<a href="tg://user?id={user.id}">{name}</a>'
 
 
-def format_text_diff(old_text: str, new_text: str) -> str:
+# Движок диффа для уведомлений об изменениях:
+# "word" — сравнение по словам/пробелам/знакам (дешевле и читаемее), "char" — по символам.
+DIFF_MODE = os.getenv("DIFF_MODE", "word")
+# Бюджет работы SequenceMatcher (произведение длин в токенах) — выше него грубый дифф.
+# Он и ограничивает время на event loop (около 1 мс, см. bench/bench_text_diff.py):
+# выносить дифф в поток бессмысленно, SequenceMatcher — чистый Python и держит GIL.
+DIFF_MAX_WORK = int(os.getenv("DIFF_MAX_WORK", "50000"))
+
+_DIFF_TOKEN_RE = re.compile(r"\s+|\w+|[^\w\s]")
+
+
+def _diff_tokens(text: str, mode: str) -> List[str]:
+    if mode == "char":
+        return list(text)
+    return _DIFF_TOKEN_RE.findall(text)
+
+
+def format_text_diff(old_text: str, new_text: str, mode: Optional[str] = None) -> str:
     """Форматирует различия между старым и новым текстом: старый зачёркнут, новый жирным."""
     if old_text == new_text:
         return escape(new_text)
-    
-    # Используем SequenceMatcher для более точного определения различий
-    matcher = SequenceMatcher(None, old_text, new_text)
-    result_parts = []
-    old_pos = 0
-    new_pos = 0
-    prev_was_delete = False
-    
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        if tag == 'equal':
-            # Неизменённая часть
-            result_parts.append(escape(old_text[i1:i2]))
-            old_pos = i2
-            new_pos = j2
-            prev_was_delete = False
-        elif tag == 'replace':
-            # Заменённая часть: старый текст зачёркнут (не жирным), новый жирным, рядом друг с другом
-            old_part = escape(old_text[i1:i2])
-            new_part = escape(new_text[j1:j2])
-            if old_part:
-                result_parts.append(f"<s>{old_part}</s>")
-            if new_part:
-                result_parts.append(f"<b>{new_part}</b>")
-            old_pos = i2
-            new_pos = j2
-            prev_was_delete = False
-        elif tag == 'delete':
-            # Удалённая часть - зачёркнута
-            result_parts.append(f"<s>{escape(old_text[i1:i2])}</s>")
-            old_pos = i2
-            prev_was_delete = True
-        elif tag == 'insert':
-            # Вставленная часть - жирным, рядом с зачёркнутым если был delete
-            if prev_was_delete:
-                result_parts.append(f"<b>{escape(new_text[j1:j2])}</b>")
+
+    a = _diff_tokens(old_text, mode or DIFF_MODE)
+    b = _diff_tokens(new_text, mode or DIFF_MODE)
+
+    # Общие начало и конец отрезаем сразу — обычно правка маленькая
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    a_mid = a[prefix:len(a) - suffix]
+    b_mid = b[prefix:len(b) - suffix]
+
+    result_parts = [escape("".join(a[:prefix]))]
+
+    def removed(tokens: List[str]) -> None:
+        if tokens:
+            result_parts.append(f"<s>{escape(''.join(tokens))}</s>")
+
+    def added(tokens: List[str]) -> None:
+        if tokens:
+            result_parts.append(f"<b>{escape(''.join(tokens))}</b>")
+
+    if len(a_mid) * len(b_mid) > DIFF_MAX_WORK:
+        # Слишком дорого для SequenceMatcher — показываем середину целиком: было / стало
+        removed(a_mid)
+        added(b_mid)
+    else:
+        # Пробелы — половина токенов и почти все ложные совпадения; якорями служат только слова.
+        # autojunk оставлен: частые слова («и», «в») дают длинные списки кандидатов и
+        # делают пословный дифф медленнее посимвольного
+        isjunk = str.isspace if (mode or DIFF_MODE) != "char" else None
+        matcher = SequenceMatcher(isjunk, a_mid, b_mid)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                # Неизменённая часть
+                result_parts.append(escape("".join(a_mid[i1:i2])))
             else:
-                result_parts.append(f"<b>{escape(new_text[j1:j2])}</b>")
-            new_pos = j2
-            prev_was_delete = False
-    
+                # replace / delete / insert: старое зачёркнуто, новое жирным, рядом друг с другом
+                removed(a_mid[i1:i2])
+                added(b_mid[j1:j2])
+
+    result_parts.append(escape("".join(a[len(a) - suffix:])))
     return "".join(result_parts)
 
-async def push_live_event(owner_id: int, event: dict) -> None:
+
+# ========= SSE: РАССЫЛКА LIVE-СОБЫТИЙ =========
+# У каждого SSE-клиента своя ограниченная очередь, а писателем служит задача
+# его же HTTP-обработчика, поэтому медленный клиент не задерживает остальных.
+# Событие сериализуется в байты один раз и делится между всеми клиентами владельца.
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "256"))
+# drop_oldest — выкидывать старые кадры; disconnect — отключать отстающего клиента
+SSE_SLOW_POLICY = os.getenv("SSE_SLOW_POLICY", "drop_oldest")
+
+# Сколько последних кадров на владельца держим в памяти для переподключений;
+# более старые пропуски дочитываются из SQLite, но не больше SSE_REPLAY_MAX событий
+SSE_REPLAY_BUFFER = int(os.getenv("SSE_REPLAY_BUFFER", "100"))
+SSE_REPLAY_MAX = int(os.getenv("SSE_REPLAY_MAX", "1000"))
+# Буферы держим для стольких владельцев с самыми свежими событиями (LRU)
+SSE_REPLAY_OWNERS = int(os.getenv("SSE_REPLAY_OWNERS", "1000"))
+
+SSE_STATS: Dict[str, int] = {
+    "published": 0,
+    "delivered": 0,
+    "dropped": 0,
+    "slow_disconnects": 0,
+    "replayed_memory": 0,
+    "replayed_db": 0,
+    "replay_duplicates": 0,
+    "resets": 0,
+    "heartbeats": 0,
+    "reaped": 0,
+    "evicted": 0,
+    "rejected": 0,
+}
+
+# Раз в SSE_HEARTBEAT_INTERVAL секунд тишины шлём комментарий-пинг: прокси не рвут
+# соединение, а полуоткрытое соединение обнаруживается на записи. Запись, не
+# уложившаяся в SSE_WRITE_TIMEOUT, считается мёртвым клиентом.
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+SSE_WRITE_TIMEOUT = float(os.getenv("SSE_WRITE_TIMEOUT", "30"))
+# Лимиты одновременных потоков: на пользователя (лишний вытесняет самый старый) и всего
+SSE_MAX_PER_USER = int(os.getenv("SSE_MAX_PER_USER", "5"))
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "5000"))
+# Через сколько секунд клиенту повторить подключение, если потоков уже SSE_MAX_STREAMS
+SSE_BUSY_RETRY_AFTER = int(os.getenv("SSE_BUSY_RETRY_AFTER", "10"))
+
+# Открытые потоки, включая ещё не зарегистрированные (prepare/догрузка)
+_SSE_OPEN_STREAMS = 0
+
+_SSE_HEARTBEAT_FRAME = b": ping\n\n"
+
+# owner_id -> deque[(event_id, frame)]; вытесненный владелец дочитывается из БД
+_LIVE_REPLAY: "OrderedDict[int, deque]" = OrderedDict()
+
+# Клиент пропустил слишком много — пусть перезагрузит список через /api/messages
+_SSE_RESET_FRAME = b"event: reset\ndata: {}\n\n"
+# Поток вытеснен более новым подключением того же пользователя — переподключаться не нужно
+_SSE_EVICTED_FRAME = b"event: evicted\ndata: {}\n\n"
+
+
+def _sse_busy_frame() -> bytes:
+    retry_after = SSE_BUSY_RETRY_AFTER
+    return f"retry: {retry_after * 1000}\nevent: busy\ndata: {{\"retry_after\": {retry_after}}}\n\n".encode()
+
+
+class SSEClient:
+    """Одно SSE-подключение Mini App: очередь готовых кадров и цикл записи."""
+
+    def __init__(self, owner_id: int, resp: web.StreamResponse) -> None:
+        self.owner_id = owner_id
+        self.resp = resp
+        self.queue: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        # Последний кадр перед закрытием (например, _SSE_EVICTED_FRAME)
+        self.farewell: Optional[bytes] = None
+        # События с id не больше этого уже ушли догрузкой
+        self.replayed_until = 0
+
+    def preload(self, frames: List[bytes], replayed_until: int) -> None:
+        """Поставить догружаемые кадры перед уже накопленными live-кадрами."""
+        self.replayed_until = replayed_until
+        self.queue.extendleft(reversed(frames))
+        self.wakeup.set()
+
+    def offer(self, frame: bytes, event_id: int) -> None:
+        """Поставить кадр в очередь, не блокируясь (вызывается из publish)."""
+        if self.closed:
+            return
+        if event_id <= self.replayed_until:
+            # Закоммичено до чтения догрузки, а опубликовано уже после регистрации
+            SSE_STATS["replay_duplicates"] += 1
+            return
+        if len(self.queue) >= SSE_QUEUE_SIZE:
+            if SSE_SLOW_POLICY == "disconnect":
+                SSE_STATS["slow_disconnects"] += 1
+                self.close()
+                return
+            self.queue.popleft()
+            SSE_STATS["dropped"] += 1
+        self.queue.append(frame)
+        self.wakeup.set()
+
+    def close(self, farewell: Optional[bytes] = None) -> None:
+        if farewell is not None and not self.closed:
+            self.farewell = farewell
+        self.closed = True
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        """Писать кадры из очереди, пока клиент не отключится."""
+        while not self.closed:
+            if not self.queue:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), SSE_HEARTBEAT_INTERVAL)
+                    continue
+                except asyncio.TimeoutError:
+                    frame = _SSE_HEARTBEAT_FRAME
+                    SSE_STATS["heartbeats"] += 1
+            else:
+                frame = self.queue.popleft()
+            try:
+                await asyncio.wait_for(self.resp.write(frame), SSE_WRITE_TIMEOUT)
+            except (ConnectionResetError, RuntimeError, asyncio.TimeoutError):
+                SSE_STATS["reaped"] += 1
+                break
+            if frame is not _SSE_HEARTBEAT_FRAME:
+                SSE_STATS["delivered"] += 1
+        self.closed = True
+        SSE_STATS["dropped"] += len(self.queue)
+        self.queue.clear()
+        if self.farewell is not None:
+            try:
+                await asyncio.wait_for(self.resp.write(self.farewell), SSE_WRITE_TIMEOUT)
+            except (ConnectionResetError, RuntimeError, asyncio.TimeoutError):
+                pass
+
+
+def sse_open_streams() -> int:
+    return _SSE_OPEN_STREAMS
+
+
+def register_live_client(client: SSEClient) -> None:
+    clients = LIVE_CLIENTS.setdefault(client.owner_id, [])
+    # Лишние вкладки одного пользователя вытесняют самые старые потоки; вытесненный
+    # получает событие evicted и не переподключается, иначе вкладки выбивали бы друг друга
+    while len(clients) >= SSE_MAX_PER_USER:
+        SSE_STATS["evicted"] += 1
+        clients.pop(0).close(_SSE_EVICTED_FRAME)
+    clients.append(client)
+
+
+def unregister_live_client(client: SSEClient) -> None:
+    clients = LIVE_CLIENTS.get(client.owner_id)
+    if not clients:
+        return
+    try:
+        clients.remove(client)
+    except ValueError:
+        pass
+    if not clients:
+        LIVE_CLIENTS.pop(client.owner_id, None)
+
+
+def _sse_frame(event: dict) -> bytes:
+    return f"id: {event['id']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
+
+
+def push_live_event(owner_id: int, event: dict) -> None:
     """
     Отправляет событие всем подключённым Mini App клиентам (SSE)
     """
+    frame = _sse_frame(event)
+    replay = _LIVE_REPLAY.get(owner_id)
+    if replay is None:
+        replay = _LIVE_REPLAY[owner_id] = deque(maxlen=SSE_REPLAY_BUFFER)
+        if len(_LIVE_REPLAY) > SSE_REPLAY_OWNERS:
+            _LIVE_REPLAY.popitem(last=False)
+    else:
+        _LIVE_REPLAY.move_to_end(owner_id)
+    replay.append((event["id"], frame))
+
     clients = LIVE_CLIENTS.get(owner_id)
     if not clients:
         return
 
-    dead = []
+    SSE_STATS["published"] += 1
+    for client in clients:
+        client.offer(frame, event["id"])
+
+
+def query_events_after(conn: sqlite3.Connection, owner_id: int, after_id: int, limit: int) -> List[Dict[str, Any]]:
+    """События владельца с id > after_id по возрастанию id (для догрузки SSE)."""
+    rows = conn.execute(
+        """
+        SELECT id, owner_id, event_type, author, content, old_content, timestamp, chat_id, message_id, version
+        FROM events
+        WHERE owner_id = ? AND id > ?
+        ORDER BY id
+        LIMIT ?
+        """,
+        (owner_id, after_id, limit),
+    ).fetchall()
+    return _hydrate_event_rows(conn, rows)
+
+
+async def collect_replay(owner_id: int, last_event_id: int) -> Tuple[List[bytes], int]:
+    """Кадры, пропущенные клиентом после last_event_id, и id последнего из них."""
+    buffered = _LIVE_REPLAY.get(owner_id) or ()
+    # Буфер — непрерывный хвост событий владельца (id общие на всех, поэтому с пропусками):
+    # если последнее виденное клиентом событие в нём, всё после него тоже в нём
+    if buffered and buffered[0][0] <= last_event_id:
+        frames = [frame for event_id, frame in buffered if event_id > last_event_id]
+        SSE_STATS["replayed_memory"] += len(frames)
+        return frames, max(last_event_id, buffered[-1][0])
+
+    # Пропуск длиннее буфера: дочитываем из БД, а закоммиченное уже после чтения — из буфера
+    rows = await READ_POOL.run(query_events_after, owner_id, last_event_id, SSE_REPLAY_MAX + 1)
+    if len(rows) > SSE_REPLAY_MAX:
+        SSE_STATS["resets"] += 1
+        return [_SSE_RESET_FRAME], last_event_id
+    frames = [_sse_frame(event_payload(r)) for r in rows]
+    SSE_STATS["replayed_db"] += len(frames)
+    newest = rows[-1]["id"] if rows else last_event_id
+    for event_id, frame in _LIVE_REPLAY.get(owner_id, ()):
+        if event_id > newest:
+            frames.append(frame)
+            newest = event_id
+    return frames, newest
+
+
+def sse_metrics() -> Dict[str, Any]:
+    return {
+        "clients": sse_open_streams(),
+        "owners": len(LIVE_CLIENTS),
+        "queued": sum(len(client.queue) for c in LIVE_CLIENTS.values() for client in c),
+        **SSE_STATS,
+    }
+
+
+# ========= ФОНОВАЯ ЗАПИСЬ В БД =========
+# save_event / remember_message не пишут в SQLite сами: строки уходят в очередь,
+# а фоновая задача сбрасывает их пачками — одна транзакция на DB_WRITE_BATCH_SIZE
+# строк или раз в DB_WRITE_FLUSH_INTERVAL секунд (что наступит раньше).
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "200"))
+DB_WRITE_FLUSH_INTERVAL = int(os.getenv("DB_WRITE_FLUSH_INTERVAL_MS", "250")) / 1000
+DB_WRITER_STOP_TIMEOUT = float(os.getenv("DB_WRITER_STOP_TIMEOUT", "30"))
+
+_DB_WRITE_QUEUE: Optional[asyncio.Queue] = None
+_DB_WRITER_TASK: Optional[asyncio.Task] = None
+# Отдельное соединение: пишет только фоновый поток, _cur/_db остаются за event loop
+_writer_db: Optional[sqlite3.Connection] = None
+
+_INSERT_EVENT_SQL = """
+    INSERT INTO events
+    (owner_id, event_type, author, content, old_content, timestamp, chat_id, message_id, version)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами (в секундах)."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = {f"le_{bound * 1000:g}ms": n for bound, n in zip(self.BUCKETS, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "buckets": buckets,
+        }
+
+
+DB_WRITE_LATENCY = LatencyHistogram()
 
-    for resp in clients:
+
+DB_WRITE_RETRIES = int(os.getenv("DB_WRITE_RETRIES", "3"))
+
+
+def _writer_connection() -> sqlite3.Connection:
+    global _writer_db
+    if _writer_db is None:
+        _writer_db = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+        _writer_db.execute("PRAGMA synchronous=NORMAL")
+    return _writer_db
+
+
+def _write_one(conn: sqlite3.Connection, sql: str, params: Tuple) -> Optional[int]:
+    """
+    Записать одну строку и вернуть её rowid (None — не записана).
+    «database is locked» повторяем с паузой, битую строку — пропускаем.
+    """
+    for attempt in range(DB_WRITE_RETRIES):
         try:
-            await resp.write(
-                f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode()
-            )
+            with conn:
+                return conn.execute(sql, params).lastrowid
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == DB_WRITE_RETRIES - 1:
+                logging.error(f"db writer: строка не записана ({e}): {sql.split()[0:4]} {params!r:.200}")
+                return None
+            time.sleep(0.1 * 2 ** attempt)
+        except sqlite3.Error as e:
+            logging.error(f"db writer: строка не записана ({e}): {sql.split()[0:4]} {params!r:.200}")
+            return None
+    return None
+
+
+def _write_batch(items: List[Tuple[str, Tuple, Any]]) -> List[Tuple[Any, Optional[int]]]:
+    """
+    Записать пачку (sql, params, on_commit) одной транзакцией (вызывается в отдельном потоке).
+    Возвращает (on_commit, rowid) для строк с колбэком — их вызывают после коммита;
+    rowid None — строка не записана.
+    """
+    conn = _writer_connection()
+    started = time.perf_counter()
+    committed = []
+    try:
+        with conn:
+            i = 0
+            while i < len(items):
+                sql, params, on_commit = items[i]
+                if on_commit is not None:
+                    # Нужен rowid строки — её пишем отдельным execute
+                    committed.append((on_commit, conn.execute(sql, params).lastrowid))
+                    i += 1
+                    continue
+                # Подряд идущие одинаковые запросы — одним executemany
+                j = i
+                while j < len(items) and items[j][0] == sql and items[j][2] is None:
+                    j += 1
+                conn.executemany(sql, [params for _, params, _ in items[i:j]])
+                i = j
+    except sqlite3.Error as e:
+        # Транзакция откатана; чтобы одна плохая строка не утянула за собой всю пачку,
+        # переписываем строки по одной
+        logging.warning(f"db writer: пачка из {len(items)} строк не записана ({e}), пишем по одной")
+        committed = []
+        for sql, params, on_commit in items:
+            rowid = _write_one(conn, sql, params)
+            if on_commit is not None:
+                committed.append((on_commit, rowid))
+    DB_WRITE_LATENCY.observe(time.perf_counter() - started)
+    return committed
+
+
+def _run_commit_callbacks(committed: List[Tuple[Any, Optional[int]]]) -> None:
+    for on_commit, rowid in committed:
+        try:
+            on_commit(rowid)
         except Exception:
-            dead.append(resp)
+            logging.exception("db writer: ошибка в колбэке после коммита")
+
+
+async def _db_writer_loop() -> None:
+    queue = _DB_WRITE_QUEUE
+    while True:
+        batch = [await queue.get()]
+        deadline = time.monotonic() + DB_WRITE_FLUSH_INTERVAL
+        while len(batch) < DB_WRITE_BATCH_SIZE:
+            # Всё, что уже в очереди, забираем без await: wait_for на каждую строку
+            # стоит ~20 мкс event loop'а
+            while len(batch) < DB_WRITE_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            timeout = deadline - time.monotonic()
+            if len(batch) >= DB_WRITE_BATCH_SIZE or timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            _run_commit_callbacks(await asyncio.to_thread(_write_batch, batch))
+        except Exception:
+            logging.exception(f"db writer: сбой записи пачки из {len(batch)} строк")
+            _run_commit_callbacks([(on_commit, None) for _, _, on_commit in batch if on_commit is not None])
+        finally:
+            for _ in batch:
+                queue.task_done()
+
 
-    # чистим мёртвые соединения
-    for resp in dead:
+def queue_db_write(sql: str, params: Tuple, on_commit=None) -> None:
+    """
+    Поставить запись в очередь фонового writer'а (или записать сразу, если он не запущен).
+    on_commit(rowid) вызывается в event loop, когда строка закоммичена, или с None,
+    если записать её не удалось.
+    """
+    if _DB_WRITE_QUEUE is not None:
+        _DB_WRITE_QUEUE.put_nowait((sql, params, on_commit))
+    else:
+        # Writer не запущен (например, вызов вне event loop) — пишем сразу
+        _run_commit_callbacks(_write_batch([(sql, params, on_commit)]))
+
+
+def start_db_writer() -> None:
+    """Запустить фоновую запись в БД (нужен работающий event loop)."""
+    global _DB_WRITE_QUEUE, _DB_WRITER_TASK
+    if _DB_WRITER_TASK is not None:
+        return
+    _DB_WRITE_QUEUE = asyncio.Queue()
+    _DB_WRITER_TASK = asyncio.get_running_loop().create_task(_db_writer_loop())
+    logging.info(
+        f"DB writer started: batch={DB_WRITE_BATCH_SIZE}, interval={DB_WRITE_FLUSH_INTERVAL * 1000:.0f}ms"
+    )
+
+
+async def stop_db_writer() -> None:
+    """Дописать всё, что осталось в очереди, и остановить фоновую запись."""
+    global _DB_WRITE_QUEUE, _DB_WRITER_TASK
+    if _DB_WRITER_TASK is None:
+        return
+    # Если writer умер, join() не дождётся никогда — не висим на остановке
+    if not _DB_WRITER_TASK.done():
         try:
-            clients.remove(resp)
-        except ValueError:
-            pass
+            await asyncio.wait_for(_DB_WRITE_QUEUE.join(), DB_WRITER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f"DB writer: не успели дописать {_DB_WRITE_QUEUE.qsize()} строк при остановке")
+    _DB_WRITER_TASK.cancel()
+    try:
+        await _DB_WRITER_TASK
+    except asyncio.CancelledError:
+        pass
+    # Недописанные строки: их колбэки узнают, что записи не будет
+    dropped = []
+    while not _DB_WRITE_QUEUE.empty():
+        _, _, on_commit = _DB_WRITE_QUEUE.get_nowait()
+        if on_commit is not None:
+            dropped.append((on_commit, None))
+    _run_commit_callbacks(dropped)
+    _DB_WRITE_QUEUE = None
+    _DB_WRITER_TASK = None
+    logging.info("DB writer stopped")
+
+
+# ========= ЧТЕНИЕ ИЗ БД: ПУЛ СОЕДИНЕНИЙ =========
+# Тяжёлые чтения (API мини-приложения) идут не через общий _cur на event loop,
+# а через пул read-only соединений в потоках. Писатель по-прежнему один — фоновый writer.
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+
+
+class ReadPool:
+    """Пул read-only соединений SQLite; запросы выполняются в потоках."""
+
+    def __init__(self, path: str, size: int) -> None:
+        self.path = path
+        self.size = size
+        self._idle: Optional[asyncio.Queue] = None
+        self.latency: Dict[str, LatencyHistogram] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def run(self, fn, *args, **kwargs):
+        """Выполнить fn(conn, *args, **kwargs) в потоке на свободном соединении."""
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                self._idle.put_nowait(None)  # соединение откроется лениво
+        conn = await self._idle.get()
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+
+        def call():
+            # Соединение возвращает в пул сам поток: если вызывающего отменили,
+            # поток ещё работает с conn, и отдать его раньше — значит делить между запросами
+            nonlocal conn
+            try:
+                if conn is None:
+                    conn = self._connect()
+                return fn(conn, *args, **kwargs)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(self._release, conn, fn.__name__, started)
+                except RuntimeError:
+                    pass  # event loop уже закрыт
+
+        # shield: отмена вызывающего не снимает задачу с executor'а до её старта
+        return await asyncio.shield(loop.run_in_executor(None, call))
+
+    def _release(self, conn: Optional[sqlite3.Connection], name: str, started: float) -> None:
+        self.latency.setdefault(name, LatencyHistogram()).observe(time.perf_counter() - started)
+        self._idle.put_nowait(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: hist.snapshot() for name, hist in self.latency.items()}
+
+
+READ_POOL = ReadPool(DB_PATH, DB_READ_POOL_SIZE)
 
 
 def save_event(
@@ -1035,59 +2218,311 @@ def save_event(
     event_type: str,
     author: str,
     content: str,
-    old_content: Optional[str] = None
+    old_content: Optional[str] = None,
+    *,
+    chat_id: Optional[int] = None,
+    message_id: Optional[int] = None,
+    version: Optional[int] = None,
 ) -> None:
-    global _cur, _db
-
     ts = int(time.time())
-
-    # ========= 1. ПАМЯТЬ (совместимость, ничего не ломаем) =========
-    history = EVENTS_HISTORY.setdefault(owner_id, [])
-
     event = {
+        "id": None,
         "type": event_type,
         "author": author,
         "content": content,
         "old_content": old_content,
         "timestamp": ts,
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "version": version,
     }
 
-    history.append(event)
+    # ========= 1. БАЗА ДАННЫХ (пачками, в фоне) =========
+    # Тексты версионированной правки уже лежат в message_versions — не дублируем их.
+    # id события выдаёт SQLite; в память и в live оно попадает уже закоммиченным,
+    # поэтому Last-Event-ID всегда можно дочитать из БД (и процессов может быть несколько)
+    stored_content, stored_old = (None, None) if version is not None else (content, old_content)
+    queue_db_write(
+        _INSERT_EVENT_SQL,
+        (owner_id, event_type, author, stored_content, stored_old, ts, chat_id, message_id, version),
+        on_commit=partial(_publish_event, owner_id, event),
+    )
 
+
+def _publish_event(owner_id: int, event: Dict[str, Any], event_id: Optional[int]) -> None:
+    if event_id is None:
+        # Строка не записана — в историю и live не попадает
+        return
+    event["id"] = event_id
+
+    # ========= 2. ПАМЯТЬ (совместимость, ничего не ломаем) =========
+    history = EVENTS_HISTORY.setdefault(owner_id, [])
+    history.append(event)
     # ограничение истории
     if len(history) > 1000:
         del history[:-1000]
 
-    # ========= 2. БАЗА ДАННЫХ =========
-    try:
-        _cur.execute(
-            """
-            INSERT INTO events
-            (owner_id, event_type, author, content, old_content, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                owner_id,
-                event_type,
-                author,
-                content,
-                old_content,
-                ts,
-            )
-        )
-        _db.commit()
-    except Exception:
-        logging.exception("save_event: DB error")
-
     # ========= 3. LIVE-ОБНОВЛЕНИЕ (НЕ БЛОКИРУЕТ БОТА) =========
-    try:
-        loop = asyncio.get_running_loop()
-        loop.create_task(push_live_event(owner_id, event))
-    except RuntimeError:
-        pass
+    # Кадр только кладётся в очереди клиентов, пишут их собственные задачи
+    push_live_event(owner_id, event)
+
+
+
+
+# ========= ИСТОРИЯ ВЕРСИЙ СООБЩЕНИЙ =========
+# Каждая правка — новая версия сообщения. Версия хранится дельтой к предыдущей
+# (копии кусков старого текста + вставки), и раз в VERSION_SNAPSHOT_EVERY версий —
+# целиком, чтобы восстановление не проходило длинную цепочку.
+VERSION_SNAPSHOT_EVERY = int(os.getenv("VERSION_SNAPSHOT_EVERY", "10"))
+VERSION_HEADS_MAX = int(os.getenv("VERSION_HEADS_MAX", "10000"))
+
+# (owner_id, chat_id, message_id) -> [последняя версия, её текст, версий после снимка,
+#                                     записей в очереди writer'а]
+_VERSION_HEADS: "OrderedDict[Tuple[int, int, int], List[Any]]" = OrderedDict()
+# Вытесненные головы, чьи версии ещё не закоммичены: MAX(version) из БД для них
+# отстаёт, и без них следующая правка получила бы уже занятый номер
+_UNFLUSHED_VERSION_HEADS: Dict[Tuple[int, int, int], List[Any]] = {}
 
+_INSERT_VERSION_SQL = """
+    INSERT INTO message_versions
+    (owner_id, chat_id, message_id, version, kind, data, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
 
 
+def make_text_delta(old: str, new: str) -> list:
+    """
+    Дельта old -> new: список из [start, end] (скопировать old[start:end]) и строк (вставить).
+    Совпадения ищутся по словам, как в format_text_diff.
+    """
+    ops: list = []
+
+    def copy(start: int, end: int) -> None:
+        if end <= start:
+            return
+        if ops and isinstance(ops[-1], list) and ops[-1][1] == start:
+            ops[-1][1] = end
+        else:
+            ops.append([start, end])
+
+    def insert(text: str) -> None:
+        if not text:
+            return
+        if ops and isinstance(ops[-1], str):
+            ops[-1] += text
+        else:
+            ops.append(text)
+
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    a_mid = old[prefix:len(old) - suffix]
+    b_mid = new[prefix:len(new) - suffix]
+
+    copy(0, prefix)
+    a_tokens = _DIFF_TOKEN_RE.findall(a_mid)
+    b_tokens = _DIFF_TOKEN_RE.findall(b_mid)
+    if a_tokens and b_tokens and len(a_tokens) * len(b_tokens) <= DIFF_MAX_WORK:
+        offsets = [prefix]
+        for token in a_tokens:
+            offsets.append(offsets[-1] + len(token))
+        matcher = SequenceMatcher(None, a_tokens, b_tokens, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                copy(offsets[i1], offsets[i2])
+            else:
+                insert("".join(b_tokens[j1:j2]))
+    else:
+        insert(b_mid)
+    copy(len(old) - suffix, len(old))
+    return ops
+
+
+def apply_text_delta(old: str, ops: list) -> str:
+    return "".join(old[op[0]:op[1]] if isinstance(op, list) else op for op in ops)
+
+
+def _select_last_version(conn: sqlite3.Connection, key: Tuple[int, int, int]) -> Optional[int]:
+    return conn.execute(
+        "SELECT MAX(version) FROM message_versions WHERE owner_id = ? AND chat_id = ? AND message_id = ?",
+        key,
+    ).fetchone()[0]
+
+
+def _take_version_head(key: Tuple[int, int, int]) -> Optional[List[Any]]:
+    head = _VERSION_HEADS.get(key)
+    if head is None:
+        head = _UNFLUSHED_VERSION_HEADS.pop(key, None)
+    return head
+
+
+def _on_version_flushed(key: Tuple[int, int, int], head: List[Any], rowid: Optional[int]) -> None:
+    head[3] -= 1
+    if rowid is None:
+        # Версия не записалась — следующую пишем снимком, а не дельтой к потерянной
+        head[2] = VERSION_SNAPSHOT_EVERY
+    if not head[3] and _UNFLUSHED_VERSION_HEADS.get(key) is head:
+        del _UNFLUSHED_VERSION_HEADS[key]
+
+
+async def record_message_version(owner_id: int, chat_id: int, message_id: int, text: str) -> int:
+    """Записать новую версию текста сообщения и вернуть её номер."""
+    key = (owner_id, chat_id, message_id)
+    head = _take_version_head(key)
+    if head is None:
+        # Голова вытеснена и дописана, или бот перезапущен — продолжаем цепочку новым снимком
+        last = await READ_POOL.run(_select_last_version, key)
+        # Пока ждали чтения, версию могла записать другая правка того же сообщения
+        head = _take_version_head(key)
+        if head is None:
+            # Текста прошлой версии нет — since_snapshot на пределе, поэтому пишется снимок
+            head = [-1 if last is None else last, None, VERSION_SNAPSHOT_EVERY, 0]
+
+    version = head[0] + 1
+    kind, data, since_snapshot = "full", text, 0
+    if head[2] + 1 < VERSION_SNAPSHOT_EVERY:
+        delta = json.dumps(make_text_delta(head[1], text), ensure_ascii=False, separators=(",", ":"))
+        if len(delta) < len(text):
+            kind, data, since_snapshot = "delta", delta, head[2] + 1
+
+    head[:3] = [version, text, since_snapshot]
+    head[3] += 1
+    queue_db_write(
+        _INSERT_VERSION_SQL,
+        (owner_id, chat_id, message_id, version, kind, data, int(time.time())),
+        on_commit=partial(_on_version_flushed, key, head),
+    )
+    _VERSION_HEADS[key] = head
+    _VERSION_HEADS.move_to_end(key)
+    if len(_VERSION_HEADS) > VERSION_HEADS_MAX:
+        evicted_key, evicted = _VERSION_HEADS.popitem(last=False)
+        if evicted[3]:
+            _UNFLUSHED_VERSION_HEADS[evicted_key] = evicted
+    return version
+
+
+async def record_edit_chain(owner_id: int, chat_id: int, message_id: int, versions: List[str]) -> List[int]:
+    """Записать исходный текст (если его ещё нет в цепочке) и все правки; номера версий правок."""
+    key = (owner_id, chat_id, message_id)
+    head = _VERSION_HEADS.get(key) or _UNFLUSHED_VERSION_HEADS.get(key)
+    if head is None or head[1] != versions[0]:
+        await record_message_version(owner_id, chat_id, message_id, versions[0])
+    return [await record_message_version(owner_id, chat_id, message_id, text) for text in versions[1:]]
+
+
+def load_message_versions(
+    conn: sqlite3.Connection,
+    owner_id: int,
+    chat_id: int,
+    message_id: int,
+    first: int = 0,
+    last: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Восстановить версии first..last (last=None — до последней), начиная с ближайшего снимка."""
+    key = (owner_id, chat_id, message_id)
+    if last is None:
+        last = 1 << 62
+    rows = conn.execute(
+        """
+        SELECT version, kind, data, timestamp
+        FROM message_versions
+        WHERE owner_id = ? AND chat_id = ? AND message_id = ? AND version <= ?
+          AND version >= COALESCE((
+              SELECT MAX(version) FROM message_versions
+              WHERE owner_id = ? AND chat_id = ? AND message_id = ? AND version <= ? AND kind = 'full'
+          ), 0)
+        ORDER BY version
+        """,
+        (*key, last, *key, first),
+    ).fetchall()
+    return list(_replay_versions(rows, first))
+
+
+def _replay_versions(rows: List[sqlite3.Row], first: int):
+    """Пройти строки одной цепочки (по возрастанию версии) и отдать версии с first."""
+    text: Optional[str] = None
+    for row in rows:
+        if row["kind"] == "full":
+            text = row["data"]
+        elif text is not None:
+            text = apply_text_delta(text, json.loads(row["data"]))
+        else:
+            continue
+        if row["version"] >= first:
+            yield {"version": row["version"], "text": text, "timestamp": row["timestamp"]}
+
+
+def load_version_texts(
+    conn: sqlite3.Connection,
+    ranges: Dict[Tuple[int, int, int], Tuple[int, int]],
+) -> Dict[Tuple[int, int, int, int], str]:
+    """Тексты версий first..last сразу для нескольких сообщений одним запросом."""
+    if not ranges:
+        return {}
+    values = ", ".join(["(?, ?, ?, ?, ?)"] * len(ranges))
+    params = [p for key, (first, last) in ranges.items() for p in (*key, first, last)]
+    rows = conn.execute(
+        f"""
+        WITH wanted(owner_id, chat_id, message_id, first, last) AS (VALUES {values})
+        SELECT v.owner_id, v.chat_id, v.message_id, v.version, v.kind, v.data, v.timestamp, w.first
+        FROM wanted w
+        JOIN message_versions v
+          ON v.owner_id = w.owner_id AND v.chat_id = w.chat_id AND v.message_id = w.message_id
+        WHERE v.version <= w.last
+          AND v.version >= COALESCE((
+              SELECT MAX(s.version) FROM message_versions s
+              WHERE s.owner_id = w.owner_id AND s.chat_id = w.chat_id AND s.message_id = w.message_id
+                AND s.version <= w.first AND s.kind = 'full'
+          ), 0)
+        ORDER BY v.owner_id, v.chat_id, v.message_id, v.version
+        """,
+        params,
+    ).fetchall()
+    texts = {}
+    for key, chain in groupby(rows, key=lambda row: (row["owner_id"], row["chat_id"], row["message_id"])):
+        chain = list(chain)
+        for v in _replay_versions(chain, chain[0]["first"]):
+            texts[(*key, v["version"])] = v["text"]
+    return texts
+
+
+def _hydrate_event_rows(conn: sqlite3.Connection, rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
+    """Строки events как dict; тексты версионированных правок собираются из message_versions."""
+    result = [dict(row) for row in rows]
+    # Версии всех правок страницы — одним запросом, по диапазону на сообщение
+    ranges: Dict[Tuple[int, int, int], Tuple[int, int]] = {}
+    for event in result:
+        if event.get("version") is not None and event["content"] is None:
+            key = (event["owner_id"], event["chat_id"], event["message_id"])
+            first, last = ranges.get(key, (event["version"] - 1, event["version"]))
+            ranges[key] = (min(first, event["version"] - 1), max(last, event["version"]))
+    texts = load_version_texts(conn, ranges)
+    for event in result:
+        if event.get("version") is not None and event["content"] is None:
+            key = (event["owner_id"], event["chat_id"], event["message_id"])
+            event["content"] = texts.get((*key, event["version"]))
+            event["old_content"] = texts.get((*key, event["version"] - 1))
+    return result
+
+
+def event_payload(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Событие в формате API / SSE."""
+    return {
+        "id": event["id"],
+        "type": event["event_type"],
+        "author": event["author"],
+        "content": event["content"],
+        "old_content": event["old_content"],
+        "timestamp": event["timestamp"],
+        "chat_id": event.get("chat_id"),
+        "message_id": event.get("message_id"),
+        "version": event.get("version"),
+    }
+
 
 def remember_message(message: types.Message) -> None:
     """Store last seen version of a message to show on edit/delete."""
@@ -1287,6 +2722,177 @@ async def try_copy_to_log_chat(
         )
         return False
 
+# ========= ИСХОДЯЩИЕ СООБЩЕНИЯ: ЛИМИТЫ И ОЧЕРЕДЬ =========
+# Все send*/copy*/forward* запросы проходят через OutboundThrottleMiddleware:
+# общий token bucket (~30 msg/s на бота) + bucket на каждый чат (~1 msg/s),
+# RetryAfter — повтор с ожиданием. 5xx не повторяются: сообщение могло уйти.
+# Хендлеры могут не ждать доставки: send_later() кладёт отправку в очередь чата,
+# у каждого чата своя задача — уведомления чата уходят по порядку, а ожидание
+# лимита одного чата не задерживает другие.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        # asyncio.Lock отдаёт захват в порядке ожидания — токены выдаются FIFO
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+
+_GLOBAL_BUCKET = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+_CHAT_BUCKETS: Dict[int, TokenBucket] = {}
+_SEND_LATENCIES: "deque[float]" = deque(maxlen=1000)
+OUTBOUND_STATS: Dict[str, int] = {"sent": 0, "failed": 0, "retry_after": 0}
+
+# chat_id -> очередь отправок и задача, которая её разбирает (живёт, пока очередь не пуста)
+_OUTBOUND_QUEUES: Dict[Any, "deque[Tuple[Any, str]]"] = {}
+_OUTBOUND_TASKS: Dict[Any, asyncio.Task] = {}
+
+
+async def _acquire_send_slot(chat_id: Any) -> None:
+    bucket = _CHAT_BUCKETS.get(chat_id)
+    if bucket is None:
+        if len(_CHAT_BUCKETS) > 10000:
+            # Полные бакеты ничего не помнят — их можно выбросить
+            for cid in [c for c, b in _CHAT_BUCKETS.items() if b.is_idle()]:
+                del _CHAT_BUCKETS[cid]
+        bucket = _CHAT_BUCKETS[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+    await bucket.acquire()
+    await _GLOBAL_BUCKET.acquire()
+
+
+class OutboundThrottleMiddleware(BaseRequestMiddleware):
+    """Request middleware aiogram: лимиты на отправку + повтор при RetryAfter."""
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        name = type(method).__name__
+        # SendChatAction — не сообщение, в лимит сообщений чата он не входит
+        throttled = (
+            chat_id is not None
+            and name != "SendChatAction"
+            and name.startswith(("Send", "Copy", "Forward"))
+        )
+        if not throttled:
+            return await make_request(bot, method)
+
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            await _acquire_send_slot(chat_id)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                OUTBOUND_STATS["retry_after"] += 1
+                if attempt >= OUTBOUND_MAX_RETRIES:
+                    OUTBOUND_STATS["failed"] += 1
+                    raise
+                logging.warning(f"Flood control for chat {chat_id}: retry after {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                OUTBOUND_STATS["failed"] += 1
+                raise
+            else:
+                OUTBOUND_STATS["sent"] += 1
+                _SEND_LATENCIES.append(time.monotonic() - started)
+                return result
+            attempt += 1
+
+
+def send_later(factory, *, chat_id: Any, description: str = "send") -> None:
+    """
+    Поставить отправку в очередь и не ждать доставки.
+    factory — функция без аргументов, возвращающая корутину (например, lambda: bot.send_message(...)).
+    Отправки в один чат выполняются по порядку, разные чаты друг друга не ждут.
+    """
+    queue = _OUTBOUND_QUEUES.get(chat_id)
+    if queue is None:
+        queue = _OUTBOUND_QUEUES[chat_id] = deque()
+    queue.append((factory, description))
+    if chat_id not in _OUTBOUND_TASKS:
+        _OUTBOUND_TASKS[chat_id] = asyncio.get_running_loop().create_task(_drain_outbound_queue(chat_id))
+
+
+async def _run_outbound_job(factory, description: str) -> None:
+    try:
+        await factory()
+    except Exception as e:
+        logging.warning(f"Outbound {description} failed: {e!r}")
+
+
+async def _drain_outbound_queue(chat_id: Any) -> None:
+    queue = _OUTBOUND_QUEUES[chat_id]
+    try:
+        while queue:
+            factory, description = queue.popleft()
+            await _run_outbound_job(factory, description)
+    finally:
+        # Между последним popleft и этим местом await нет — новая отправка заведёт новую задачу
+        del _OUTBOUND_QUEUES[chat_id]
+        del _OUTBOUND_TASKS[chat_id]
+
+
+async def stop_outbound_queues(timeout: float = 10.0) -> None:
+    """Дождаться отправки очередей (не дольше timeout) и остановить их задачи."""
+    deadline = time.monotonic() + timeout
+    # Пока ждём, отправки могут завести очереди новых чатов
+    while _OUTBOUND_TASKS and time.monotonic() < deadline:
+        await asyncio.wait(list(_OUTBOUND_TASKS.values()), timeout=deadline - time.monotonic())
+    if _OUTBOUND_TASKS:
+        logging.warning(f"Outbound queue not drained: {_outbound_queue_depth()} messages dropped")
+        pending = list(_OUTBOUND_TASKS.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _outbound_queue_depth() -> int:
+    return sum(len(q) for q in _OUTBOUND_QUEUES.values())
+
+
+def outbound_metrics() -> Dict[str, Any]:
+    latencies = sorted(_SEND_LATENCIES)
+
+    def pct(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else 0.0
+
+    return {
+        **OUTBOUND_STATS,
+        "queue_depth": _outbound_queue_depth(),
+        "chat_queues": len(_OUTBOUND_QUEUES),
+        "chat_buckets": len(_CHAT_BUCKETS),
+        "latency_p50": pct(0.5),
+        "latency_p95": pct(0.95),
+        "latency_max": round(latencies[-1], 4) if latencies else 0.0,
+    }
+
+
 def get_rofl_inline_kb() -> InlineKeyboardMarkup:
     """Красивые кнопки для выбора типа рофла (в ряд)."""
     return InlineKeyboardMarkup(
@@ -1744,12 +3350,128 @@ async def handle_echo(message: types.Message) -> None:
     )
 
 
+# ========= СКЛЕЙКА БЫСТРЫХ ПРАВОК =========
+# Правки одного сообщения (chat_id, message_id), идущие с паузами меньше
+# EDIT_COALESCE_WINDOW, копятся и уходят одним уведомлением: дифф считается между
+# исходным и итоговым текстом. Серия не откладывается дольше EDIT_COALESCE_MAX_DELAY.
+EDIT_COALESCE_WINDOW = int(os.getenv("EDIT_COALESCE_WINDOW_MS", "3000")) / 1000
+EDIT_COALESCE_MAX_DELAY = int(os.getenv("EDIT_COALESCE_MAX_DELAY_MS", "15000")) / 1000
+
+# (chat_id, message_id) -> накопленная серия правок
+_PENDING_EDITS: Dict[Tuple[int, int], Dict[str, Any]] = {}
+
+
+def queue_edit_notification(
+    bot: Bot,
+    key: Tuple[int, int],
+    *,
+    target_chat: int,
+    owner_id: Optional[int],
+    author_mention: str,
+    old_text: str,
+    new_text: str,
+) -> None:
+    """Добавить правку в серию и (пере)запустить таймер отправки."""
+    now = time.monotonic()
+    pending = _PENDING_EDITS.get(key)
+    if pending is None:
+        pending = _PENDING_EDITS[key] = {
+            "bot": bot,
+            "target_chat": target_chat,
+            "owner_id": owner_id,
+            "author_mention": author_mention,
+            "versions": [old_text],
+            "started": now,
+            "task": None,
+        }
+    pending["versions"].append(new_text)
+    if pending["task"] is not None:
+        pending["task"].cancel()
+    delay = min(EDIT_COALESCE_WINDOW, max(0.0, pending["started"] + EDIT_COALESCE_MAX_DELAY - now))
+    pending["task"] = asyncio.get_running_loop().create_task(_flush_edit_later(key, delay))
+
+
+async def _flush_edit_later(key: Tuple[int, int], delay: float) -> None:
+    await asyncio.sleep(delay)
+    await _flush_edit(key)
+
+
+async def _flush_edit(key: Tuple[int, int]) -> None:
+    # Серию забираем до первого await: новые правки начнут следующую
+    pending = _PENDING_EDITS.pop(key, None)
+    if pending is None:
+        return
+    versions = pending["versions"]
+    original, final = versions[0], versions[-1]
+    target_chat = pending["target_chat"]
+    author_mention = pending["author_mention"]
+
+    stars_text = (
+        "\n\n"
+        f"<a href=\"https://t.me/SaveModStarsBot\">Telegram Stars со скидкой</a> 🌟"
+    )
+    edits_note = f" {escape(f'Правок подряд: {len(versions) - 1}.')}" if len(versions) > 2 else ""
+
+    # Форматируем изменения для строчки "Изменилось:"
+    changed_text = format_text_diff(original, final)
+
+    send_later(
+        partial(
+            pending["bot"].send_message,
+            chat_id=target_chat,
+            text=(
+                f"🔏 {author_mention} {escape('изменил сообщение.')}{edits_note}\n\n"
+                f"<b>Старый текст:</b> <blockquote>{escape(original)}</blockquote>\n"
+                f"<b>Новый текст:</b> <blockquote>{escape(final)}</blockquote>\n"
+                f"Изменилось:\n<blockquote>{changed_text}</blockquote>"
+                f"{stars_text}"
+            ),
+        ),
+        chat_id=target_chat,
+        description=f"edit notification to {target_chat}",
+    )
+
+    # Сохраняем событие в историю: по событию на правку, тексты — в цепочке версий
+    owner_id = pending["owner_id"]
+    if owner_id:
+        # Извлекаем имя автора из HTML ссылки
+        author_name = author_mention
+        if '<a href' in author_name:
+            # Парсим имя из HTML
+            match = re.search(r'>([^<]+)<', author_name)
+            author_name = match.group(1) if match else 'Неизвестно'
+        chat_id, message_id = key
+        version_ids = await record_edit_chain(owner_id, chat_id, message_id, versions)
+        for previous, current, version in zip(versions, versions[1:], version_ids):
+            save_event(
+                owner_id, 'edited', author_name, current, previous,
+                chat_id=chat_id, message_id=message_id, version=version,
+            )
+
+
+async def flush_pending_edit(key: Tuple[int, int]) -> None:
+    """Отправить серию правок сообщения, не дожидаясь таймера."""
+    pending = _PENDING_EDITS.get(key)
+    if pending is None:
+        return
+    if pending["task"] is not None:
+        pending["task"].cancel()
+    await _flush_edit(key)
+
+
+async def flush_pending_edits() -> None:
+    """Отправить все накопленные серии правок сразу (при остановке бота)."""
+    for key in list(_PENDING_EDITS):
+        await flush_pending_edit(key)
+
+
 async def on_edited_message(message: types.Message) -> None:
     # ← Добавляем проверку нового бота здесь
+    await check_scam_bots(message)
     await warn_about_new_bot_and_offer_report(message)
 
     key = (message.chat.id, message.message_id)
-    old = MESSAGE_LOG.get(key)
+    old = await MESSAGE_LOG.get(key)
     new_text = message.text or message.caption or "<без текста>"
     remember_message(message)
 
@@ -1795,52 +3517,140 @@ async def on_edited_message(message: types.Message) -> None:
                 "\n\n"
                 f"<a href=\"https://t.me/SaveModStarsBot\">Telegram Stars со скидкой</a> 🌟"
             )
-            await message.bot.send_message(
-                chat_id=target_chat,
-                text=(
-                    f"{escape('Сообщение изменено, но старой версии нет в кэше.')}\n"
-                    f"Новое: <blockquote>{escape(new_text)}</blockquote>"
-                    f"{stars_text}"
+            send_later(
+                partial(
+                    message.bot.send_message,
+                    chat_id=target_chat,
+                    text=(
+                        f"{escape('Сообщение изменено, но старой версии нет в кэше.')}\n"
+                        f"Новое: <blockquote>{escape(new_text)}</blockquote>"
+                        f"{stars_text}"
+                    ),
                 ),
+                chat_id=target_chat,
+                description=f"edit notification to {target_chat}",
             )
             return
 
         # Используем сохранённую ссылку на автора из old['user'], а не создаём новую
         author_mention = old.get('user', user_mention(message.from_user))
-        
-        stars_text = (
-            "\n\n"
-            f"<a href=\"https://t.me/SaveModStarsBot\">Telegram Stars со скидкой</a> 🌟"
-        )
-        
-        # Форматируем изменения для строчки "Изменилось:"
-        changed_text = format_text_diff(old['content'], new_text)
-        
-        await message.bot.send_message(
-            chat_id=target_chat,
-            text=(
-                f"🔏 {author_mention} {escape('изменил сообщение.')}\n\n"
-                f"<b>Старый текст:</b> <blockquote>{escape(old['content'])}</blockquote>\n"
-                f"<b>Новый текст:</b> <blockquote>{escape(new_text)}</blockquote>\n"
-                f"Изменилось:\n<blockquote>{changed_text}</blockquote>"
-                f"{stars_text}"
-            ),
+
+        # Серия быстрых правок одного сообщения уходит одним уведомлением
+        queue_edit_notification(
+            message.bot,
+            key,
+            target_chat=target_chat,
+            owner_id=owner_id,
+            author_mention=author_mention,
+            old_text=old['content'],
+            new_text=new_text,
         )
-        
-        # Сохраняем событие в историю
-        if owner_id:
-            # Извлекаем имя автора из HTML ссылки
-            author_name = old.get('user', 'Неизвестно')
-            if '<a href' in author_name:
-                # Парсим имя из HTML
-                match = re.search(r'>([^<]+)<', author_name)
-                author_name = match.group(1) if match else 'Неизвестно'
-            save_event(owner_id, 'edited', author_name, new_text, old['content'])
     else:
         # Это не бизнес-сообщение - не отправляем уведомление
         logging.debug(f"Not a business message, skipping notification")
 
 
+# ========= ОТЧЁТЫ ОБ УДАЛЕНИЯХ: СКЛЕЙКА И НАРЕЗКА =========
+# Удаления, пришедшие в один чат логов в пределах DELETE_REPORT_WINDOW, уходят одним
+# отчётом, а отчёт режется на сообщения не длиннее лимита Telegram по границам записей.
+DELETE_REPORT_WINDOW = int(os.getenv("DELETE_REPORT_WINDOW_MS", "1500")) / 1000
+TELEGRAM_TEXT_LIMIT = 4096
+
+_DELETE_REPORT_FOOTER = (
+    "\n\n"
+    f"<a href=\"https://t.me/SaveModStarsBot\">Telegram Stars со скидкой</a> 🌟"
+)
+_DELETE_REPORT_SEP = "\n\n"
+
+# target_chat -> накопленные блоки отчёта
+_PENDING_DELETE_REPORTS: Dict[int, List[str]] = {}
+_DELETE_REPORT_TASKS: Dict[int, asyncio.Task] = {}
+
+
+def _tg_len(text: str) -> int:
+    """Длина так, как её считает Telegram (в UTF-16 code units); разметка считается с запасом."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def deleted_message_blocks(author_mention: str, content: str, limit: int = TELEGRAM_TEXT_LIMIT) -> List[str]:
+    """Блок(и) отчёта об одном удалённом сообщении; слишком длинный текст делится на части."""
+    head = f"🗑️ {escape('Это сообщение было удалено')}\n\n<blockquote>{author_mention}\n"
+    tail = "</blockquote>"
+    budget = limit - _tg_len(head) - _tg_len(tail) - _tg_len(_DELETE_REPORT_FOOTER)
+    blocks = []
+    rest = content
+    while True:
+        piece = rest[:budget]
+        # escape может удлинить текст — укорачиваем кусок, пока не влезет
+        while len(piece) > 1 and (size := _tg_len(escape(piece))) > budget:
+            piece = piece[:max(1, min(len(piece) - 1, len(piece) * budget // size))]
+        blocks.append(f"{head}{escape(piece)}{tail}")
+        rest = rest[len(piece):]
+        if not rest:
+            return blocks
+
+
+def chunk_report(blocks: List[str], footer: str = "", limit: int = TELEGRAM_TEXT_LIMIT) -> List[str]:
+    """Разложить блоки по сообщениям не длиннее limit; footer — в конец последнего."""
+    budget = limit - _tg_len(footer)
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for block in blocks:
+        extra = _tg_len(block) + (_tg_len(_DELETE_REPORT_SEP) if current else 0)
+        if current and size + extra > budget:
+            chunks.append(_DELETE_REPORT_SEP.join(current))
+            current, size = [], 0
+            extra = _tg_len(block)
+        current.append(block)
+        size += extra
+    if current:
+        chunks.append(_DELETE_REPORT_SEP.join(current))
+    if chunks:
+        chunks[-1] += footer
+    return chunks
+
+
+async def _send_chunks(bot: Bot, chat_id: int, chunks: List[str]) -> None:
+    # Части одного отчёта идут по порядку одной задачей очереди
+    for chunk in chunks:
+        await bot.send_message(chat_id, chunk)
+
+
+def _flush_delete_report(bot: Bot, target_chat: int) -> None:
+    _DELETE_REPORT_TASKS.pop(target_chat, None)
+    blocks = _PENDING_DELETE_REPORTS.pop(target_chat, None)
+    if not blocks:
+        return
+    chunks = chunk_report(blocks, _DELETE_REPORT_FOOTER)
+    send_later(
+        partial(_send_chunks, bot, target_chat, chunks),
+        chat_id=target_chat,
+        description=f"delete notification to {target_chat} ({len(blocks)} msgs, {len(chunks)} parts)",
+    )
+
+
+async def _flush_delete_report_later(bot: Bot, target_chat: int) -> None:
+    await asyncio.sleep(DELETE_REPORT_WINDOW)
+    _flush_delete_report(bot, target_chat)
+
+
+def queue_delete_report(bot: Bot, target_chat: int, blocks: List[str]) -> None:
+    """Добавить блоки в отчёт для target_chat; отчёт уйдёт по окончании окна."""
+    _PENDING_DELETE_REPORTS.setdefault(target_chat, []).extend(blocks)
+    if target_chat not in _DELETE_REPORT_TASKS:
+        _DELETE_REPORT_TASKS[target_chat] = asyncio.get_running_loop().create_task(
+            _flush_delete_report_later(bot, target_chat)
+        )
+
+
+def flush_delete_reports(bot: Bot) -> None:
+    """Отправить все накопленные отчёты сразу (при остановке бота)."""
+    for target_chat, task in list(_DELETE_REPORT_TASKS.items()):
+        task.cancel()
+        _flush_delete_report(bot, target_chat)
+
+
 async def on_deleted_business_messages(
     event: BusinessMessagesDeleted,
     bot: Bot,
@@ -1854,7 +3664,7 @@ async def on_deleted_business_messages(
     # Фолбэк: иногда bc_id может не прийти в update — попробуем восстановить по кэшу сообщений
     if not bc_id:
         for mid in deleted_ids:
-            cached = MESSAGE_LOG.get((chat.id, mid))
+            cached = await MESSAGE_LOG.get((chat.id, mid))
             if cached and cached.get("business_connection_id"):
                 bc_id = cached.get("business_connection_id")
                 break
@@ -1886,18 +3696,20 @@ async def on_deleted_business_messages(
             await send_subscription_required_notification(bot, target_chat, owner_id)
             return
         
+        # Окно склейки правок длиннее окна удалений: серию правок удалённого
+        # сообщения отправляем сейчас, иначе она придёт уже после отчёта об удалении
+        for mid in deleted_ids:
+            await flush_pending_edit((chat.id, mid))
+
         logging.info(f"Sending deleted messages notification to chat_id={target_chat}")
         lines = []
         for mid in deleted_ids:
             key = (chat.id, mid)
-            cached = MESSAGE_LOG.get(key)
+            cached = await MESSAGE_LOG.get(key)
             if cached:
                 # Используем сохранённую ссылку на автора из cached['user']
                 author_mention = cached.get('user', 'кто-то')
-                lines.append(
-                    f"🗑️ {escape('Это сообщение было удалено')}\n\n"
-                    f"<blockquote>{author_mention}\n{escape(cached['content'])}</blockquote>"
-                )
+                lines.extend(deleted_message_blocks(author_mention, cached['content']))
                 
                 # Сохраняем событие в историю
                 if owner_id:
@@ -1913,12 +3725,8 @@ async def on_deleted_business_messages(
                 # Не показываем уведомление о несохранённых сообщениях, чтобы не шуметь
 
         if lines:
-            stars_text = (
-                "\n\n"
-                f"<a href=\"https://t.me/SaveModStarsBot\">Telegram Stars со скидкой</a> 🌟"
-            )
-            report = "\n\n".join(lines) + stars_text
-            await bot.send_message(target_chat, report)
+            # Соседние удаления склеиваются в один отчёт, длинный — режется на части
+            queue_delete_report(bot, target_chat, lines)
         else:
             # Все удалённые сообщения были без кэша - не отправляем пустое уведомление
             logging.debug(f"All {len(deleted_ids)} deleted messages were not cached, skipping notification")
@@ -1938,6 +3746,7 @@ async def on_business_message(message: types.Message) -> None:
         f"bc_id={bc_id}, bc_in_logs={bc_id in BUSINESS_LOG_CHATS if bc_id else False}"
     )
 
+    await check_scam_bots(message)
     await warn_about_new_bot_and_offer_report(message)
     remember_message(message)
     
@@ -1975,7 +3784,7 @@ async def on_business_message(message: types.Message) -> None:
                 else:
                     # Пробуем получить из кэша
                     reply_key = (message.reply_to_message.chat.id, message.reply_to_message.message_id)
-                    cached = MESSAGE_LOG.get(reply_key)
+                    cached = await MESSAGE_LOG.get(reply_key)
                     if cached and cached.get("content"):
                         result = switch_layout(cached["content"])
                         await message.answer(result)
@@ -2052,7 +3861,8 @@ async def on_business_message(message: types.Message) -> None:
             if not target_chat_id:
                 return
             
-            # Проверяем подписку
+            # Проверяем подписку (мимо кэша — это тестовая команда)
+            invalidate_subscription(user_id)
             is_sub = await is_subscribed(message.bot, user_id)
             
             if is_sub:
@@ -2140,7 +3950,7 @@ async def on_business_message(message: types.Message) -> None:
         )
         if not ok:
             # Фолбэк: если копирование недоступно, пробуем отправить по сохранённому file_id
-            cached = MESSAGE_LOG.get((message.chat.id, replied.message_id))
+            cached = await MESSAGE_LOG.get((message.chat.id, replied.message_id))
             if cached and cached.get("media_file_id"):
                 await send_cached_media(
                     message.bot,
@@ -2185,12 +3995,12 @@ async def on_business_connection(
     if connection.is_enabled and chat_id:
         # Запоминаем, куда слать логи по этому бизнес-подключению + кто владелец
         BUSINESS_LOG_CHATS[connection.id] = {"chat_id": chat_id, "owner_id": owner_id}
-        save_business_connections()
+        schedule_save_business_connections()
         logging.info(f"Added business connection: id={connection.id}, chat_id={chat_id}, total_connections={len(BUSINESS_LOG_CHATS)}")
     elif not connection.is_enabled:
         # Удаляем из списка при отключении, чтобы не отправлять уведомления
         BUSINESS_LOG_CHATS.pop(connection.id, None)
-        save_business_connections()
+        schedule_save_business_connections()
         logging.info(f"Removed business connection: id={connection.id}, remaining_connections={len(BUSINESS_LOG_CHATS)}")
 
     if not chat_id:
@@ -2578,6 +4388,8 @@ async def on_callback_prank_zaebu(callback: types.CallbackQuery) -> None:
 async def on_callback_check_sub(callback: types.CallbackQuery) -> None:
     if not callback.from_user:
         return
+    # Юзер мог только что подписаться — спрашиваем Telegram заново, а не кэш
+    invalidate_subscription(callback.from_user.id)
     ok = await is_subscribed(callback.bot, callback.from_user.id)
     if ok:
         await callback.message.answer("✅ Подписка найдена! Доступ открыт.", reply_markup=MAIN_KEYBOARD)
@@ -2585,16 +4397,9 @@ async def on_callback_check_sub(callback: types.CallbackQuery) -> None:
         await callback.message.answer("❌ Подписка не найдена. Подпишись и попробуй снова.", reply_markup=SUBSCRIBE_KB)
     await callback.answer()
 
-async def on_report_new_bot(callback: types.CallbackQuery):
+async def on_report_new_bot(callback: types.CallbackQuery, bot_key: str, chat_id: int):
     """Когда юзер жмёт "Отправить на проверку" — тебе приходит сообщение с кнопками"""
-    parts = callback.data.split("_")
-    if len(parts) < 4:
-        await callback.answer("Ошибка данных", show_alert=True)
-        return
-
-    bot_key = parts[3]          # bot_royaltrust_robot или mention_...
-    chat_id = int(parts[4])     # чат владельца
-
+    # bot_key — bot_royaltrust_robot или mention_..., chat_id — чат владельца
     # Достаём читаемое имя из ключа
     bot_display = bot_key.replace("bot_", "@").replace("mention_", "@")
 
@@ -2607,13 +4412,15 @@ async def on_report_new_bot(callback: types.CallbackQuery):
         f"Что делать?"
     )
 
+    # Один токен на все три кнопки решения
+    token = store_callback_payload(bot_key, chat_id)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_bot_{bot_key}_{chat_id}"),
-            InlineKeyboardButton("🚫 Скам",     callback_data=f"mark_scam_{bot_key}_{chat_id}"),
+            InlineKeyboardButton(text="✅ Одобрить", callback_data=pack_callback("ap", token)),
+            InlineKeyboardButton(text="🚫 Скам",     callback_data=pack_callback("sc", token)),
         ],
         [
-            InlineKeyboardButton("❌ Игнорировать", callback_data=f"ignore_bot_{bot_key}_{chat_id}"),
+            InlineKeyboardButton(text="❌ Игнорировать", callback_data=pack_callback("ig", token)),
         ]
     ])
 
@@ -2628,18 +4435,14 @@ async def on_report_new_bot(callback: types.CallbackQuery):
     except Exception as e:
         await callback.answer(f"Ошибка: {str(e)}", show_alert=True)
 
-async def on_approve_bot(callback: types.CallbackQuery):
+async def on_approve_bot(callback: types.CallbackQuery, bot_key: str, chat_id: int):
     if callback.from_user.id != OWNER_ID:
         await callback.answer("Только владелец может решать", show_alert=True)
         return
 
-    parts = callback.data.split("_")
-    bot_key = parts[2]
-    chat_id = int(parts[3])
-
     # Удаляем из seen_bots — больше предупреждений не будет
-    _cur.execute("DELETE FROM seen_bots WHERE bot_id = ?", (bot_key,))
-    _db.commit()
+    SEEN_BOTS.discard(bot_key)
+    queue_db_write("DELETE FROM seen_bots WHERE bot_id = ?", (bot_key,))
 
     # Уведомляем владельца чата
     await callback.bot.send_message(
@@ -2653,21 +4456,17 @@ async def on_approve_bot(callback: types.CallbackQuery):
     )
     await callback.answer("Одобрено!")
 
-async def on_mark_scam(callback: types.CallbackQuery):
+async def on_mark_scam(callback: types.CallbackQuery, bot_key: str, chat_id: int):
     if callback.from_user.id != OWNER_ID:
         await callback.answer("Только владелец может решать", show_alert=True)
         return
 
-    parts = callback.data.split("_")
-    bot_key = parts[2]
-    chat_id = int(parts[3])
-
     # Добавляем в scam_bots
-    _cur.execute(
+    queue_db_write(
         "INSERT OR REPLACE INTO scam_bots (bot_id, reason, added_by, added_at) VALUES (?, ?, ?, ?)",
-        (bot_key, "Помечен как скам владельцем", OWNER_ID, int(time.time()))
+        (bot_key, "Помечен как скам владельцем", OWNER_ID, int(time.time())),
     )
-    _db.commit()
+    add_scam_bot(bot_key, "Помечен как скам владельцем")
 
     # Уведомляем владельца чата
     await callback.bot.send_message(
@@ -2681,71 +4480,370 @@ async def on_mark_scam(callback: types.CallbackQuery):
     )
     await callback.answer("Помечен как скам!")
 
-async def on_ignore_bot(callback: types.CallbackQuery):
+async def on_ignore_bot(callback: types.CallbackQuery, bot_key: str, chat_id: int):
     if callback.from_user.id != OWNER_ID:
         await callback.answer("Только владелец может решать", show_alert=True)
         return
 
-    parts = callback.data.split("_")
-    bot_key = parts[2]
-    chat_id = int(parts[3])
-
     # Редактируем сообщение у админа
     await callback.message.edit_text(
         callback.message.text + "\n\n❌ Игнорировано владельцем"
     )
     await callback.answer("Игнорировано")
 
+# ========= РОУТЕР CALLBACK-КНОПОК =========
+# Вместо цепочки фильтров-лямбд (каждое нажатие проверяло их по очереди) — один
+# обработчик: точные совпадения ищутся в словаре, а кнопки с данными имеют вид
+# "<префикс>:<токен>", поля берутся из хранилища токенов.
+_CALLBACK_SEP = ":"
+
+
+def pack_callback(prefix: str, token: str) -> str:
+    """Упаковать префикс и токен в callback_data."""
+    return f"{prefix}{_CALLBACK_SEP}{token}"
+
+
+class CallbackRouter:
+    """Диспетчер callback_query: dict точных совпадений + dict префиксов токенов."""
+
+    def __init__(self) -> None:
+        self.exact: Dict[str, Any] = {}
+        # prefix -> handler; поля берутся из хранилища токенов
+        self.tokens: Dict[str, Any] = {}
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self.errors: Dict[str, int] = {}
+        self.unmatched = 0
+
+    def route(self, data: str, handler) -> None:
+        self.exact[data] = handler
+
+    def route_token(self, prefix: str, handler) -> None:
+        self.tokens[prefix] = handler
+
+    async def _resolve(self, data: str):
+        handler = self.exact.get(data)
+        if handler is not None:
+            return data, handler, ()
+        prefix, sep, rest = data.partition(_CALLBACK_SEP)
+        handler = self.tokens.get(prefix) if sep else None
+        if handler is None:
+            return None
+        fields = await load_callback_payload(rest)
+        if fields is None:
+            return prefix, _on_expired_button, ()
+        return prefix, handler, fields
+
+    async def dispatch(self, callback: types.CallbackQuery) -> None:
+        data = callback.data or ""
+        try:
+            resolved = await self._resolve(data)
+        except ValueError as e:
+            logging.warning(f"Некорректные callback_data {data!r}: {e}")
+            self.errors["<bad_payload>"] = self.errors.get("<bad_payload>", 0) + 1
+            await callback.answer("Ошибка данных", show_alert=True)
+            return
+        if resolved is None:
+            # Кнопки старых форматов ещё висят в чатах — без ответа клиент крутит спиннер
+            self.unmatched += 1
+            await _on_expired_button(callback)
+            return
+        name, handler, args = resolved
+        started = time.perf_counter()
+        try:
+            await handler(callback, *args)
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            hist = self.latency.get(name)
+            if hist is None:
+                hist = self.latency[name] = LatencyHistogram()
+            hist.observe(time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routes": {name: hist.snapshot() for name, hist in self.latency.items()},
+            "errors": dict(self.errors),
+            "unmatched": self.unmatched,
+        }
+
+
+# ========= ТОКЕНЫ ДАННЫХ КНОПОК =========
+# Ключ бота и чат не влезают в 64 байта callback_data при длинных именах, поэтому
+# кнопка хранит непрозрачный токен, а сами поля лежат в SQLite (кнопки продолжают
+# работать после перезапуска, пока не истечёт срок). В памяти — LRU недавних токенов.
+CALLBACK_PAYLOAD_TTL = int(os.getenv("CALLBACK_PAYLOAD_TTL_DAYS", "30")) * 86400
+CALLBACK_PAYLOADS_MAX = int(os.getenv("CALLBACK_PAYLOADS_MAX", "10000"))
+
+# token -> (поля, expires_at), от давно не использованных к свежим
+_CALLBACK_PAYLOADS: "OrderedDict[str, Tuple[tuple, int]]" = OrderedDict()
+
+
+def _remember_callback_payload(token: str, fields: tuple, expires_at: int) -> None:
+    _CALLBACK_PAYLOADS[token] = (fields, expires_at)
+    _CALLBACK_PAYLOADS.move_to_end(token)
+    while len(_CALLBACK_PAYLOADS) > CALLBACK_PAYLOADS_MAX:
+        _CALLBACK_PAYLOADS.popitem(last=False)
+
+
+def store_callback_payload(*fields: Any) -> str:
+    """Сохранить поля кнопки и вернуть короткий токен для callback_data."""
+    token = secrets.token_urlsafe(9)  # 12 символов
+    expires_at = int(time.time()) + CALLBACK_PAYLOAD_TTL
+    _remember_callback_payload(token, fields, expires_at)
+    queue_db_write(
+        "INSERT OR REPLACE INTO callback_payloads (token, payload, expires_at) VALUES (?, ?, ?)",
+        (token, json.dumps(fields, ensure_ascii=False), expires_at),
+    )
+    return token
+
+
+def _select_callback_payload(conn: sqlite3.Connection, token: str) -> Optional[sqlite3.Row]:
+    return conn.execute(
+        "SELECT payload, expires_at FROM callback_payloads WHERE token = ?", (token,)
+    ).fetchone()
+
+
+async def load_callback_payload(token: str) -> Optional[tuple]:
+    """Поля кнопки по токену (None — токен неизвестен или истёк)."""
+    entry = _CALLBACK_PAYLOADS.get(token)
+    if entry is None:
+        # Вытеснен из памяти или перезапуск — читаем по первичному ключу
+        try:
+            row = await READ_POOL.run(_select_callback_payload, token)
+        except Exception as e:
+            logging.error(f"callback payloads: ошибка чтения из БД: {e}")
+            return None
+        if row is None:
+            return None
+        entry = (tuple(json.loads(row["payload"])), row["expires_at"])
+    fields, expires_at = entry
+    if expires_at <= time.time():
+        _CALLBACK_PAYLOADS.pop(token, None)
+        return None
+    _remember_callback_payload(token, fields, expires_at)
+    return fields
+
+
+def prune_callback_payloads() -> int:
+    """Удалить истёкшие токены кнопок из БД."""
+    _cur.execute("DELETE FROM callback_payloads WHERE expires_at <= ?", (int(time.time()),))
+    _db.commit()
+    return _cur.rowcount
+
+
+async def _on_expired_button(callback: types.CallbackQuery) -> None:
+    await callback.answer("Кнопка устарела", show_alert=True)
+
+
+CALLBACK_ROUTER = CallbackRouter()
+
+
+def register_callback_routes(router: CallbackRouter) -> None:
+    router.route("more_rofl", on_callback_rofl)
+    router.route("dark_rofl", on_callback_dark_rofl)
+    router.route("more_dark_rofl", on_callback_more_dark_rofl)
+    router.route("refresh_instruction", on_callback_refresh_instruction)
+    router.route("help_instruction", on_callback_help_instruction)
+    router.route("quick_rofl", on_callback_quick_rofl)
+    router.route("quick_coin", on_callback_quick_coin)
+    router.route("quick_instruction", on_callback_quick_instruction)
+    router.route("quick_help", on_callback_quick_help)
+    router.route("cmd_desc_rofl", on_callback_cmd_desc_rofl)
+    router.route("cmd_desc_mock", on_callback_cmd_desc_mock)
+    router.route("cmd_desc_coin", on_callback_cmd_desc_coin)
+    router.route("cmd_desc_instruction", on_callback_cmd_desc_instruction)
+    router.route("cmd_desc_help", on_callback_cmd_desc_help)
+    router.route("cmd_desc_start", on_callback_cmd_desc_start)
+    router.route("open_prank_menu", on_callback_open_prank_menu)
+    router.route("prank_type", on_callback_prank_type)
+    router.route("prank_switch", on_callback_prank_switch)
+    router.route("prank_kawaii", on_callback_prank_kawaii)
+    router.route("prank_love", on_callback_prank_love)
+    router.route("prank_iq", on_callback_prank_iq)
+    router.route("prank_info", on_callback_prank_info)
+    router.route("prank_zaebu", on_callback_prank_zaebu)
+    router.route("check_sub", on_callback_check_sub)
+
+    # Модерация ботов: в кнопке токен, по нему — ключ бота и чат владельца
+    router.route_token("rp", on_report_new_bot)
+    router.route_token("ap", on_approve_bot)
+    router.route_token("sc", on_mark_scam)
+    router.route_token("ig", on_ignore_bot)
+
+
 # HTTP сервер для мини-приложения
+API_MESSAGES_DEFAULT_LIMIT = 100
+API_MESSAGES_MAX_LIMIT = 500
+
+
+def query_events(
+    conn: sqlite3.Connection,
+    owner_id: int,
+    *,
+    before_id: Optional[int] = None,
+    since_id: Optional[int] = None,
+    limit: int = API_MESSAGES_DEFAULT_LIMIT,
+    event_type: Optional[str] = None,
+    from_ts: Optional[int] = None,
+    to_ts: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Страница событий владельца, новые сверху. Keyset-пагинация по (timestamp, id)
+    на индексе idx_events_owner_ts_id: before_id — старше курсора, since_id — новее.
+    """
+    where = ["owner_id = ?"]
+    params: List[Any] = [owner_id]
+    if event_type:
+        where.append("event_type = ?")
+        params.append(event_type)
+    if from_ts is not None:
+        where.append("timestamp >= ?")
+        params.append(from_ts)
+    if to_ts is not None:
+        where.append("timestamp < ?")
+        params.append(to_ts)
+
+    order = "DESC"
+    cursor_id = before_id if before_id is not None else since_id
+    if cursor_id is not None:
+        cursor_row = conn.execute(
+            "SELECT timestamp FROM events WHERE id = ? AND owner_id = ?", (cursor_id, owner_id)
+        ).fetchone()
+        if cursor_row is None:
+            return []
+        if before_id is not None:
+            where.append("(timestamp, id) < (?, ?)")
+        else:
+            where.append("(timestamp, id) > (?, ?)")
+            # Ближайшие к курсору — по возрастанию, потом разворачиваем
+            order = "ASC"
+        params.extend((cursor_row["timestamp"], cursor_id))
+
+    rows = conn.execute(
+        f"""
+        SELECT id, owner_id, event_type, author, content, old_content, timestamp, chat_id, message_id, version
+        FROM events
+        WHERE {" AND ".join(where)}
+        ORDER BY timestamp {order}, id {order}
+        LIMIT ?
+        """,
+        (*params, limit),
+    ).fetchall()
+    if order == "ASC":
+        rows.reverse()
+    return _hydrate_event_rows(conn, rows)
+
+
+def _optional_int(value: Any) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
 async def api_messages_handler(request: web.Request) -> web.Response:
     try:
         data = await request.json()
     except Exception:
         return web.json_response({"messages": []})
 
-    init_data = data.get("initData")
-    user_id = data.get("user_id")
+    # initData мини-приложение шлёт заголовком; поле в теле — для совместимости
+    init_data = request.headers.get("X-Telegram-Init-Data") or data.get("initData")
 
-    # 🔐 Защита Telegram Mini App
-    if not init_data or not verify_telegram_init_data(init_data, BOT_TOKEN):
+    # 🔐 Защита Telegram Mini App: владелец событий — подписанный пользователь из initData
+    user_id = verify_init_data(init_data)
+    if user_id is None:
         return web.json_response({"error": "unauthorized"}, status=403)
 
     try:
-        user_id = int(user_id)
+        before_id = _optional_int(data.get("before_id"))
+        since_id = _optional_int(data.get("since_id"))
+        from_ts = _optional_int(data.get("from_ts"))
+        to_ts = _optional_int(data.get("to_ts"))
+        limit = _optional_int(data.get("limit")) or API_MESSAGES_DEFAULT_LIMIT
     except Exception:
-        return web.json_response({"messages": []})
+        return web.json_response({"error": "bad request"}, status=400)
+    limit = max(1, min(limit, API_MESSAGES_MAX_LIMIT))
+    event_type = data.get("type")
+    if event_type in (None, "", "all"):
+        event_type = None
 
     # 📦 ЧТЕНИЕ ИЗ БД
     try:
-        _cur.execute(
-            """
-            SELECT event_type, author, content, old_content, timestamp
-            FROM events
-            WHERE owner_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 500
-            """,
-            (user_id,)
+        rows = await READ_POOL.run(
+            query_events,
+            user_id,
+            before_id=before_id,
+            since_id=since_id,
+            limit=limit,
+            event_type=event_type,
+            from_ts=from_ts,
+            to_ts=to_ts,
         )
-        rows = _cur.fetchall()
     except Exception as e:
         logging.error(f"DB read error: {e}")
         rows = []
 
     return web.json_response({
-        "messages": [
-            {
-                "type": r["event_type"],
-                "author": r["author"],
-                "content": r["content"],
-                "old_content": r["old_content"],
-                "timestamp": r["timestamp"],
-            }
-            for r in rows
-        ]
+        "messages": [event_payload(r) for r in rows],
+        # Курсор следующей (более старой) страницы; None — дальше пусто
+        "next_before_id": rows[-1]["id"] if len(rows) == limit else None,
     })
 
 
+async def api_message_history_handler(request: web.Request) -> web.Response:
+    """Все версии одного сообщения (лента правок в мини-приложении)."""
+    try:
+        data = await request.json()
+    except Exception:
+        return web.json_response({"error": "bad request"}, status=400)
+
+    init_data = request.headers.get("X-Telegram-Init-Data") or data.get("initData")
+    user_id = verify_init_data(init_data)
+    if user_id is None:
+        return web.json_response({"error": "unauthorized"}, status=403)
+
+    try:
+        chat_id = int(data["chat_id"])
+        message_id = int(data["message_id"])
+    except Exception:
+        return web.json_response({"error": "bad request"}, status=400)
+
+    try:
+        versions = await READ_POOL.run(load_message_versions, user_id, chat_id, message_id)
+    except Exception as e:
+        logging.error(f"DB read error: {e}")
+        versions = []
+    return web.json_response({"versions": versions})
+
+
+# Внутренние метрики; эндпоинт выключен, пока не задан METRICS_TOKEN
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+def collect_metrics() -> Dict[str, Any]:
+    return {
+        "message_cache": MESSAGE_LOG.stats(),
+        "subscription": subscription_metrics(),
+        "outbound": outbound_metrics(),
+        "updates": {**(UPDATE_PIPELINE.stats() if UPDATE_PIPELINE else {}), "webhook_rejected": WEBHOOK_STATS["rejected"]},
+        "db": {"write": DB_WRITE_LATENCY.snapshot(), "read": READ_POOL.stats()},
+        "sse": sse_metrics(),
+        "callbacks": CALLBACK_ROUTER.stats(),
+        "init_data": {**INIT_DATA_STATS, "cached": len(_INIT_DATA_CACHE)},
+    }
+
+
+async def api_metrics_handler(request: web.Request) -> web.Response:
+    if not METRICS_TOKEN:
+        return web.Response(status=404)
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    # Байты, а не str: compare_digest падает с TypeError на не-ASCII строках
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return web.Response(status=403)
+    return web.json_response(collect_metrics())
+
+
 @web.middleware
 async def cors_middleware(request: web.Request, handler):
     """Middleware для обработки CORS запросов."""
@@ -2753,45 +4851,153 @@ async def cors_middleware(request: web.Request, handler):
         response = web.Response()
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Telegram-Init-Data'
         return response
     return await handler(request)
 
 
+# ========= СТАТИКА МИНИ-ПРИЛОЖЕНИЯ =========
+# Файлы webapp/ читаются в память один раз (и перечитываются при изменении, если
+# включён STATIC_AUTO_RELOAD), сразу сжимаются gzip/brotli и получают ETag.
+# Запрос к статике — поиск в словаре, без обращения к диску.
+STATIC_DIR = Path(__file__).parent / "webapp"
+STATIC_AUTO_RELOAD = os.getenv("STATIC_AUTO_RELOAD", "0") == "1"
+
+try:
+    import brotli  # необязательная зависимость
+except ImportError:
+    brotli = None
+
+_STATIC_CONTENT_TYPES = {
+    ".html": "text/html",
+    ".css": "text/css",
+    ".js": "application/javascript",
+    ".json": "application/json",
+}
+_COMPRESSIBLE_TYPES = {"text/html", "text/css", "application/javascript", "application/json"}
+
+
+class StaticAsset:
+    """Файл статики в памяти: исходные байты, сжатые варианты и ETag на каждый."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        stat = path.stat()
+        self.mtime_ns = stat.st_mtime_ns
+        body = path.read_bytes()
+        self.content_type = _STATIC_CONTENT_TYPES.get(path.suffix, "text/html")
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        # encoding -> (body, etag); у каждого варианта свой сильный ETag
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (body, f'"{digest}"')}
+        if self.content_type in _COMPRESSIBLE_TYPES:
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                self.variants["gzip"] = (gz, f'"{digest}-gz"')
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.variants["br"] = (br, f'"{digest}-br"')
+
+    def is_stale(self) -> bool:
+        try:
+            return self.path.stat().st_mtime_ns != self.mtime_ns
+        except OSError:
+            return True
+
+
+STATIC_ASSETS: Dict[str, StaticAsset] = {}
+
+
+def load_static_assets() -> None:
+    """Загрузить все файлы webapp/ в память."""
+    assets = {}
+    for path in STATIC_DIR.rglob("*"):
+        if path.is_file():
+            assets[path.relative_to(STATIC_DIR).as_posix()] = StaticAsset(path)
+    STATIC_ASSETS.clear()
+    STATIC_ASSETS.update(assets)
+    logging.info(f"Static assets loaded: {len(assets)} files")
+
+
+def _accepted_encodings(header: str) -> set:
+    """Кодировки из Accept-Encoding, кроме явно запрещённых через q=0."""
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and float(params[2:] or 0) == 0:
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
 async def static_handler(request: web.Request) -> web.Response:
     """Обработчик статических файлов."""
-    path = request.match_info.get('path', 'index.html')
-    file_path = Path(__file__).parent / 'webapp' / path
-    
-    if not file_path.exists() or not file_path.is_file():
+    path = request.match_info.get('path') or 'index.html'
+    asset = STATIC_ASSETS.get(path)
+    if asset is not None and STATIC_AUTO_RELOAD and asset.is_stale():
+        try:
+            asset = STATIC_ASSETS[path] = StaticAsset(asset.path)
+        except OSError:
+            STATIC_ASSETS.pop(path, None)
+            asset = None
+    if asset is None:
         return web.Response(status=404)
-    
-    content_type = 'text/html'
-    if path.endswith('.css'):
-        content_type = 'text/css'
-    elif path.endswith('.js'):
-        content_type = 'application/javascript'
-    elif path.endswith('.json'):
-        content_type = 'application/json'
-    
-    return web.Response(
-        body=file_path.read_bytes(),
-        content_type=content_type
-    )
 
+    try:
+        accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    except ValueError:
+        accepted = set()
+    encoding = next((e for e in ("br", "gzip") if e in asset.variants and e in accepted), "identity")
+    body, etag = asset.variants[encoding]
+
+    headers = {
+        "ETag": etag,
+        # Имена файлов без хэшей, поэтому браузер каждый раз переспрашивает — и получает 304
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in if_none_match.split(",")):
+        return web.Response(status=304, headers=headers)
 
-async def start_http_server(port: Optional[int] = None) -> None:
-    """Запустить HTTP сервер для мини-приложения."""
+    return web.Response(body=body, content_type=asset.content_type, charset="utf-8", headers=headers)
+
+
+async def start_http_server(
+    port: Optional[int] = None,
+    *,
+    dp: Optional[Dispatcher] = None,
+    bot: Optional[Bot] = None,
+) -> None:
+    """Запустить HTTP сервер для мини-приложения (и приёма webhook, если он включён)."""
     # Порт можно задать через переменную окружения PORT (для облачных платформ)
     if port is None:
         port = int(os.getenv("PORT", "8080"))
     
     app = web.Application(middlewares=[cors_middleware])
+    load_static_assets()
+
+    # Webhook Telegram: проверка секрета, мгновенный 200 и обработка апдейта в фоне
+    if WEBHOOK_URL and dp is not None and bot is not None:
+        BoundedRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True,
+        ).register(app, path=WEBHOOK_PATH)
+        logging.info(f"Webhook endpoint mounted at {WEBHOOK_PATH}")
     
     # API эндпоинты
     app.router.add_post('/api/messages', api_messages_handler)
     app.router.add_options('/api/messages', api_messages_handler)
+    app.router.add_post('/api/messages/history', api_message_history_handler)
+    app.router.add_options('/api/messages/history', api_message_history_handler)
     app.router.add_get('/api/events/stream', api_events_stream_handler)
+    app.router.add_get('/api/metrics', api_metrics_handler)
     
     # Статические файлы
     app.router.add_get('/', static_handler)
@@ -2805,6 +5011,108 @@ async def start_http_server(port: Optional[int] = None) -> None:
     logging.info(f"HTTP server started on http://0.0.0.0:{port}")
 
 
+# ========= ОБРАБОТКА АПДЕЙТОВ: ПОРЯДОК ВНУТРИ ЧАТА =========
+# Апдейты одного чата (или одного бизнес-подключения) обрабатываются строго по очереди,
+# разных — параллельно, не больше UPDATE_WORKERS одновременно. Так долгий
+# download_and_reupload_media или .type у одного владельца не тормозит остальных.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
+
+
+def _update_shard_key(update: types.Update) -> Optional[Tuple[str, Any]]:
+    event = update.event
+    bc_id = getattr(event, "business_connection_id", None)
+    if bc_id:
+        return ("bc", bc_id)
+    if isinstance(event, types.CallbackQuery):
+        if event.message:
+            return ("chat", event.message.chat.id)
+        return ("user", event.from_user.id)
+    if isinstance(event, BusinessConnection):
+        return ("bc", event.id)
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return ("chat", chat.id)
+    return None
+
+
+class ChatOrderedMiddleware(BaseMiddleware):
+    """Outer middleware на update: очередь на каждый ключ шарда + общий лимит параллельности."""
+
+    def __init__(self, workers: int) -> None:
+        self._tails: Dict[Tuple[str, Any], asyncio.Future] = {}
+        self._workers = asyncio.Semaphore(workers)
+        self.pending = 0
+        self.running = 0
+
+    async def __call__(self, handler, event: types.Update, data: Dict[str, Any]) -> Any:
+        key = _update_shard_key(event)
+        if key is None:
+            return await handler(event, data)
+
+        prev = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        self.pending += 1
+        if self.pending > UPDATE_MAX_PENDING:
+            logging.warning(f"Update pipeline overloaded: pending={self.pending}")
+        try:
+            if prev is not None:
+                await asyncio.shield(prev)
+            async with self._workers:
+                self.running += 1
+                try:
+                    return await handler(event, data)
+                finally:
+                    self.running -= 1
+        finally:
+            self.pending -= 1
+            if prev is not None and not prev.done():
+                # Нас отменили, пока ждали предыдущий апдейт — следующий всё равно ждёт его
+                prev.add_done_callback(lambda _f: done.set_result(None))
+            else:
+                done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": self.pending, "running": self.running, "active_chats": len(self._tails)}
+
+
+UPDATE_PIPELINE: Optional[ChatOrderedMiddleware] = None
+WEBHOOK_STATS: Dict[str, int] = {"rejected": 0}
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook-хендлер с лимитом фоновых апдейтов (аналог tasks_concurrency_limit у polling).
+    Сверх UPDATE_MAX_PENDING отвечаем 503 — Telegram повторит доставку позже.
+    """
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if len(self._background_feed_update_tasks) >= UPDATE_MAX_PENDING:
+            WEBHOOK_STATS["rejected"] += 1
+            return web.Response(status=503, headers={"Retry-After": "1"}, text="Overloaded")
+        return await super().handle(request)
+
+
+def register_update_handlers(dp: Dispatcher) -> None:
+    # Все кнопки — через один роутер (словарь вместо перебора фильтров)
+    register_callback_routes(CALLBACK_ROUTER)
+    dp.callback_query.register(CALLBACK_ROUTER.dispatch)
+
+    if SUBSCRIPTION_INDEX:
+        dp.chat_member.register(on_channel_member)
+
+    dp.message.register(handle_echo)
+
+    # Бизнес-апдейты: по регистрациям resolve_used_update_types решает, на что подписаться
+    dp.business_connection.register(on_business_connection)
+    dp.business_message.register(on_business_message)
+    dp.edited_business_message.register(on_edited_message)
+    dp.deleted_business_messages.register(on_deleted_business_messages)
+
+
 async def main() -> None:
     if not BOT_TOKEN or BOT_TOKEN == "PASTE_YOUR_TOKEN_HERE":
         raise RuntimeError("Укажи реальный токен бота в config.py (BOT_TOKEN)")
@@ -2812,57 +5120,81 @@ async def main() -> None:
     # Загружаем сохранённые бизнес-подключения
     load_business_connections()
 
-    # Запускаем HTTP сервер для мини-приложения
-    # Порт можно задать через переменную окружения PORT
-    await start_http_server()
+    # Боты, которых уже видели, и блоклист скам-ботов (проверка в памяти на каждом бизнес-сообщении)
+    load_seen_bots()
+    load_scam_bots()
+
+    # Индекс подписчиков канала (если бот — админ канала и получает chat_member)
+    if SUBSCRIPTION_INDEX:
+        load_channel_members()
+
+    # Холодный кэш сообщений: чистим старое и прогреваем память
+    try:
+        pruned = MESSAGE_LOG.prune(MESSAGE_STORE_RETENTION)
+        warmed = MESSAGE_LOG.warm_up(MESSAGE_WARM_START)
+        logging.info(f"Message store: pruned={pruned}, warmed={warmed}")
+    except Exception as e:
+        logging.error(f"Message store warm-up failed: {e}")
+
+    try:
+        logging.info(f"Callback payloads: pruned={prune_callback_payloads()}")
+    except Exception as e:
+        logging.error(f"Callback payloads prune failed: {e}")
+
+    # Фоновая пакетная запись в БД
+    start_db_writer()
+    start_message_pruning()
 
     bot = Bot(
         token=BOT_TOKEN,
         default=DefaultBotProperties(parse_mode="HTML"),
     )
+    # Лимиты Telegram на исходящие сообщения
+    bot.session.middleware(OutboundThrottleMiddleware())
     dp = Dispatcher()
 
-    dp.callback_query.register(on_callback_rofl, lambda c: c.data == "more_rofl")
-    dp.callback_query.register(on_callback_dark_rofl, lambda c: c.data == "dark_rofl")
-    dp.callback_query.register(on_callback_more_dark_rofl, lambda c: c.data == "more_dark_rofl")
-    dp.callback_query.register(on_callback_refresh_instruction, lambda c: c.data == "refresh_instruction")
-    dp.callback_query.register(on_callback_help_instruction, lambda c: c.data == "help_instruction")
-    dp.callback_query.register(on_callback_quick_rofl, lambda c: c.data == "quick_rofl")
-    dp.callback_query.register(on_callback_quick_coin, lambda c: c.data == "quick_coin")
-    dp.callback_query.register(on_callback_quick_instruction, lambda c: c.data == "quick_instruction")
-    dp.callback_query.register(on_callback_quick_help, lambda c: c.data == "quick_help")
-    dp.callback_query.register(on_callback_cmd_desc_rofl, lambda c: c.data == "cmd_desc_rofl")
-    dp.callback_query.register(on_callback_cmd_desc_mock, lambda c: c.data == "cmd_desc_mock")
-    dp.callback_query.register(on_callback_cmd_desc_coin, lambda c: c.data == "cmd_desc_coin")
-    dp.callback_query.register(on_callback_cmd_desc_instruction, lambda c: c.data == "cmd_desc_instruction")
-    dp.callback_query.register(on_callback_cmd_desc_help, lambda c: c.data == "cmd_desc_help")
-    dp.callback_query.register(on_callback_cmd_desc_start, lambda c: c.data == "cmd_desc_start")
-    dp.callback_query.register(on_callback_open_prank_menu, lambda c: c.data == "open_prank_menu")
-    dp.callback_query.register(on_callback_prank_type, lambda c: c.data == "prank_type")
-    dp.callback_query.register(on_callback_prank_switch, lambda c: c.data == "prank_switch")
-    dp.callback_query.register(on_callback_prank_kawaii, lambda c: c.data == "prank_kawaii")
-    dp.callback_query.register(on_callback_prank_love, lambda c: c.data == "prank_love")
-    dp.callback_query.register(on_callback_prank_iq, lambda c: c.data == "prank_iq")
-    dp.callback_query.register(on_callback_prank_info, lambda c: c.data == "prank_info")
-    dp.callback_query.register(on_callback_prank_zaebu, lambda c: c.data == "prank_zaebu")
-    dp.callback_query.register(on_callback_check_sub, lambda c: c.data == "check_sub")
-
-    # ← твои новые обработчики (только один раз каждый)
-    dp.callback_query.register(on_report_new_bot, lambda c: c.data.startswith("report_new_bot_"))
-    dp.callback_query.register(on_approve_bot,    lambda c: c.data.startswith("approve_bot_"))
-    dp.callback_query.register(on_mark_scam,      lambda c: c.data.startswith("mark_scam_"))
-    dp.callback_query.register(on_ignore_bot,     lambda c: c.data.startswith("ignore_bot_"))
+    # Порядок внутри чата, параллельность между чатами
+    global UPDATE_PIPELINE
+    UPDATE_PIPELINE = ChatOrderedMiddleware(UPDATE_WORKERS)
+    dp.update.outer_middleware(UPDATE_PIPELINE)
 
-    dp.message.register(handle_echo)
+    register_update_handlers(dp)
+
+    # Запускаем HTTP сервер для мини-приложения (и webhook, если задан WEBHOOK_URL)
+    # Порт можно задать через переменную окружения PORT
+    await start_http_server(dp=dp, bot=bot)
 
     await set_commands(bot)
-    logging.info("Bot starting polling...")
     logging.info(
         f"Bot is ready to be used as a Telegram Business bot. "
         f"Загружено {len(BUSINESS_LOG_CHATS)} бизнес-подключений. "
         f"Подключи его в настройках Telegram Business и выдай права на управление сообщениями."
     )
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logging.info("Bot is running in webhook mode")
+            await asyncio.Event().wait()
+        else:
+            # Если раньше стоял webhook, getUpdates вернёт Conflict — снимаем его
+            await bot.delete_webhook()
+            logging.info("Bot starting polling...")
+            await dp.start_polling(
+                bot,
+                allowed_updates=dp.resolve_used_update_types(),
+                tasks_concurrency_limit=UPDATE_MAX_PENDING,
+            )
+    finally:
+        stop_message_pruning()
+        await flush_pending_edits()
+        flush_delete_reports(bot)
+        await stop_outbound_queues()
+        await stop_db_writer()
+        flush_business_connections()
 
 
 if __name__ == "__main__":
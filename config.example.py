@@ -15,3 +15,8 @@ REQUIRED_CHANNEL_URL = "https://t.me/your_channel"
 # Для локальной разработки используйте ngrok или другой туннель
 # Для продакшена укажите ваш домен
 WEBAPP_URL = "https://your-domain.com/"
+
+# Webhook вместо long polling: публичный HTTPS-адрес сервиса (пусто — polling)
+# и секрет, который Telegram будет присылать в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = ""
+WEBHOOK_SECRET = ""
@@ -18,3 +18,8 @@ REQUIRED_CHANNEL_URL = os.getenv("REQUIRED_CHANNEL_URL", "https://t.me/eternalmo
 # URL мини-приложения (веб-приложения) для Telegram
 # Для продакшена укажите ваш домен (Railway автоматически создаст URL)
 WEBAPP_URL = "https://rofl-bot-production.up.railway.app/"
+
+# Webhook вместо long polling: укажите публичный HTTPS-адрес сервиса (тот же, где крутится мини-приложение).
+# Пусто — бот работает через polling. WEBHOOK_SECRET проверяется в заголовке X-Telegram-Bot-Api-Secret-Token.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
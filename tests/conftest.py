@@ -0,0 +1,8 @@
+"""Тесты импортируют bot.py из корня репозитория с временной БД."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="rofl-test-"), "events.db"))
+sys.path.insert(0, ROOT)
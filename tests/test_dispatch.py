@@ -0,0 +1,60 @@
+"""Бизнес-апдейты доходят до хендлеров через Dispatcher.feed_update."""
+import asyncio
+
+from aiogram import Bot, Dispatcher, types
+
+import bot
+
+BC_ID = "bc-test"
+LOG_CHAT = 999
+PEER = {"id": 777, "type": "private", "first_name": "Peer"}
+SENDER = {"id": 777, "is_bot": False, "first_name": "Peer"}
+
+
+def business_message(text: str, **extra) -> dict:
+    return {
+        "message_id": 11,
+        "date": 1760000000,
+        "business_connection_id": BC_ID,
+        "chat": PEER,
+        "from": SENDER,
+        "text": text,
+        **extra,
+    }
+
+
+def test_business_updates_are_subscribed():
+    dp = Dispatcher()
+    bot.register_update_handlers(dp)
+    used = set(dp.resolve_used_update_types())
+    assert {
+        "business_connection",
+        "business_message",
+        "edited_business_message",
+        "deleted_business_messages",
+    } <= used
+
+
+def test_edited_business_message_queues_edit_notification():
+    async def run() -> None:
+        dp = Dispatcher()
+        bot.register_update_handlers(dp)
+        tg = Bot("123456:test")
+        bot.BUSINESS_LOG_CHATS[BC_ID] = {"chat_id": LOG_CHAT, "owner_id": 0}
+        try:
+            bot.remember_message(types.Message.model_validate(business_message("привет")))
+            update = types.Update.model_validate({
+                "update_id": 1,
+                "edited_business_message": business_message("пока", edit_date=1760000005),
+            })
+            await dp.feed_update(tg, update)
+
+            pending = bot._PENDING_EDITS.pop((PEER["id"], 11))
+            pending["task"].cancel()
+            assert pending["target_chat"] == LOG_CHAT
+            assert pending["versions"] == ["привет", "пока"]
+        finally:
+            bot.BUSINESS_LOG_CHATS.pop(BC_ID, None)
+            await tg.session.close()
+
+    asyncio.run(run())
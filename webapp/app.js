@@ -55,6 +55,16 @@ function toggleTheme() {
 // ================================
 let messagesData = [];
 let filteredData = [];
+let nextBeforeId = null;
+let lastEventId = null;
+let currentFilters = { type: "all", from_ts: null };
+
+const PAGE_SIZE = 100;
+// Переподключение к live-потоку: экспоненциально от MIN до MAX, со случайной добавкой
+const LIVE_RETRY_MIN = 3000;
+const LIVE_RETRY_MAX = 60000;
+let liveRetryDelay = LIVE_RETRY_MIN;
+const PERIOD_SECONDS = { today: null, week: 7 * 86400, month: 30 * 86400 };
 
 // ================================
 // INIT
@@ -76,21 +86,87 @@ document.addEventListener("DOMContentLoaded", async () => {
 // ================================
 // API LOAD
 // ================================
-async function loadData() {
+async function fetchPage(beforeId) {
     const res = await fetch("/api/messages", {
         method: "POST",
         headers: {
             "Content-Type": "application/json",
             "X-Telegram-Init-Data": INIT_DATA,
         },
-        body: JSON.stringify({ user_id: USER_ID }),
+        body: JSON.stringify({
+            limit: PAGE_SIZE,
+            before_id: beforeId,
+            type: currentFilters.type,
+            from_ts: currentFilters.from_ts,
+        }),
     });
 
     if (!res.ok) throw new Error("API error");
+    return res.json();
+}
 
-    const data = await res.json();
+async function loadData() {
+    const data = await fetchPage(null);
     messagesData = data.messages || [];
     filteredData = messagesData;
+    nextBeforeId = data.next_before_id || null;
+    rememberEventId(messagesData.length ? messagesData[0].id : null);
+    updateLoadMore();
+}
+
+function rememberEventId(id) {
+    if (id && (!lastEventId || id > lastEventId)) lastEventId = id;
+}
+
+async function loadMore() {
+    if (!nextBeforeId) return;
+    const data = await fetchPage(nextBeforeId);
+    messagesData = messagesData.concat(data.messages || []);
+    filteredData = messagesData;
+    nextBeforeId = data.next_before_id || null;
+    updateLoadMore();
+    updateStats();
+    renderMessages();
+}
+
+function updateLoadMore() {
+    const loading = document.getElementById("loading");
+    if (loading) loading.style.display = "none";
+    const btn = document.getElementById("loadMore");
+    if (btn) btn.style.display = nextBeforeId ? "" : "none";
+}
+
+// ================================
+// FILTERS (фильтрует сервер)
+// ================================
+function periodStart(period) {
+    if (period === "today") {
+        const d = new Date();
+        d.setHours(0, 0, 0, 0);
+        return Math.floor(d.getTime() / 1000);
+    }
+    const seconds = PERIOD_SECONDS[period];
+    return seconds ? Math.floor(Date.now() / 1000) - seconds : null;
+}
+
+async function applyFilters() {
+    currentFilters = {
+        type: document.getElementById("typeFilter").value,
+        from_ts: periodStart(document.getElementById("periodFilter").value),
+    };
+    try {
+        await loadData();
+    } catch (e) {
+        console.error("applyFilters failed", e);
+    }
+    updateStats();
+    renderMessages();
+}
+
+function matchesFilters(event) {
+    if (currentFilters.type !== "all" && event.type !== currentFilters.type) return false;
+    if (currentFilters.from_ts && event.timestamp < currentFilters.from_ts) return false;
+    return true;
 }
 
 // ================================
@@ -99,13 +175,51 @@ async function loadData() {
 function initLiveUpdates() {
     if (!USER_ID || !INIT_DATA) return;
 
+    // Сервер дошлёт только пропущенное после lastEventId
+    const resume = lastEventId ? `&last_event_id=${lastEventId}` : "";
     const es = new EventSource(
-        `/api/events/stream?user_id=${USER_ID}&initData=${encodeURIComponent(INIT_DATA)}`
+        `/api/events/stream?initData=${encodeURIComponent(INIT_DATA)}${resume}`
     );
 
+    es.onopen = () => {
+        liveRetryDelay = LIVE_RETRY_MIN;
+    };
+
+    es.addEventListener("busy", (e) => {
+        // Сервер перегружен и сам говорит, когда приходить снова
+        es.close();
+        let retryAfter = 10;
+        try {
+            retryAfter = JSON.parse(e.data).retry_after || retryAfter;
+        } catch (err) {
+            console.error("SSE busy payload", err);
+        }
+        scheduleLiveReconnect(retryAfter * 1000);
+    });
+
+    es.addEventListener("evicted", () => {
+        // Поток занят более новой вкладкой — не отбираем его обратно
+        es.close();
+    });
+
+    es.addEventListener("reset", async () => {
+        // Пропущено слишком много — проще перезагрузить первую страницу
+        try {
+            await loadData();
+        } catch (err) {
+            console.error("reload failed", err);
+        }
+        updateStats();
+        renderMessages();
+    });
+
     es.onmessage = (e) => {
         try {
             const event = JSON.parse(e.data);
+            // id растут; событие, уже полученное догрузкой или страницей, не дублируем
+            if (event.id && lastEventId && event.id <= lastEventId) return;
+            rememberEventId(event.id);
+            if (!matchesFilters(event)) return;
             messagesData.unshift(event);
             filteredData = messagesData;
             updateStats();
@@ -117,10 +231,15 @@ function initLiveUpdates() {
 
     es.onerror = () => {
         es.close();
-        setTimeout(initLiveUpdates, 3000);
+        scheduleLiveReconnect(liveRetryDelay);
+        liveRetryDelay = Math.min(liveRetryDelay * 2, LIVE_RETRY_MAX);
     };
 }
 
+function scheduleLiveReconnect(delay) {
+    setTimeout(initLiveUpdates, delay + Math.random() * 1000);
+}
+
 // ================================
 // STATS
 // ================================
@@ -162,10 +281,48 @@ function renderMessages() {
                 <b>${escapeHtml(msg.author)}</b><br>
                 ${msg.content ? escapeHtml(msg.content) : "<em>Нет текста</em>"}
             </div>
+            ${msg.type === "edited" && msg.message_id ? `
+            <button class="history-toggle" onclick="toggleHistory(this, ${msg.chat_id}, ${msg.message_id})">🕓 История правок</button>
+            <div class="timeline" style="display:none;"></div>` : ""}
         </div>`;
     }).join("");
 }
 
+// ================================
+// ИСТОРИЯ ПРАВОК СООБЩЕНИЯ
+// ================================
+async function toggleHistory(button, chatId, messageId) {
+    const box = button.nextElementSibling;
+    if (box.style.display !== "none") {
+        box.style.display = "none";
+        return;
+    }
+    box.style.display = "";
+    box.innerHTML = "Загрузка…";
+
+    try {
+        const res = await fetch("/api/messages/history", {
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json",
+                "X-Telegram-Init-Data": INIT_DATA,
+            },
+            body: JSON.stringify({ chat_id: chatId, message_id: messageId }),
+        });
+        if (!res.ok) throw new Error("API error");
+        const data = await res.json();
+        const versions = data.versions || [];
+        box.innerHTML = versions.length ? versions.map(v => `
+            <div class="timeline-item">
+                <span class="message-date">v${v.version} · ${new Date(v.timestamp * 1000).toLocaleString("ru-RU")}</span>
+                <div>${escapeHtml(v.text)}</div>
+            </div>`).join("") : "<em>История недоступна</em>";
+    } catch (e) {
+        console.error("history failed", e);
+        box.innerHTML = "<em>Не удалось загрузить историю</em>";
+    }
+}
+
 // ================================
 // UTILS
 // ================================